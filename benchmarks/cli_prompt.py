@@ -0,0 +1,40 @@
+"""Compare matching CLI prompts one pattern at a time with the combined regex
+
+PYTHONPATH=. python benchmarks/cli_prompt.py [iterations]
+"""
+
+import re
+import sys
+import timeit
+
+from mb_netmgmt.__main__ import get_cli_patterns, match_cli_prompt
+
+messages = [
+    b"Building configuration...\r\n" + b" description uplink\r\n" * 200 + prompt
+    for prompt in [
+        b"\rRP/0/8/CPU0:IOSXR-2#",
+        b"\rProtocol [ipv4]: ",
+        b"\r --More-- ",
+        b"\r  Configured hold time: 180, keepalive: ",
+    ]
+]
+
+
+def match_patterns(message):
+    for pattern in get_cli_patterns():
+        if re.findall(pattern, message):
+            return True
+    return False
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, match in [
+        ("pattern list", match_patterns),
+        ("combined regex", match_cli_prompt),
+    ]:
+        seconds = timeit.timeit(
+            lambda: [match(message) for message in messages], number=iterations
+        )
+        rate = iterations * len(messages) / seconds
+        print(f"{name}: {rate:.0f} matches/s")
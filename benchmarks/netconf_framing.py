@@ -0,0 +1,63 @@
+"""Compare the throughput of base:1.0 and base:1.1 framing with a large reply
+
+The reply is framed by netconf.frame and read back in 32 KiB pieces, like
+the data of an SSH channel, by netconf.Decoder and by ncclient's parser.
+Each measurement is the best of 5 runs.
+
+    PYTHONPATH=. python benchmarks/netconf_framing.py [megabytes]
+"""
+
+import sys
+import time
+from types import SimpleNamespace
+
+from ncclient.devices.default import DefaultDeviceHandler
+from ncclient.transport.parser import DefaultXMLParser
+from ncclient.transport.session import NetconfBase
+from ncclient.transport.ssh import SSHSession
+
+from mb_netmgmt import netconf
+
+READ_SIZE = 2**15
+megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+reply = "<rpc-reply><data>" + "<a>x</a>" * (megabytes * 2**17) + "</data></rpc-reply>"
+message = "".join(netconf.add_message_id(reply, "1"))
+
+
+def decode(parser, data):
+    for start in range(0, len(data), READ_SIZE):
+        parser.parse(data[start : start + READ_SIZE])
+
+
+def measure(name, run):
+    elapsed = []
+    for _ in range(5):
+        start = time.perf_counter()
+        run()
+        elapsed.append(time.perf_counter() - start)
+    elapsed = min(elapsed)
+    print(f"{name:28} {len(reply) / 2**20 / elapsed:8.1f} MB/s")
+
+
+for base in [NetconfBase.BASE_10, NetconfBase.BASE_11]:
+    label = "1.0" if base == NetconfBase.BASE_10 else "1.1"
+    data = b"".join(netconf.frame(netconf.add_message_id(reply, "1"), base))
+    measure(
+        f"{label} encode",
+        lambda: b"".join(netconf.frame(netconf.add_message_id(reply, "1"), base)),
+    )
+    messages = []
+    session = SimpleNamespace(_base=base, _dispatch_message=messages.append)
+    measure(
+        f"{label} decode Decoder",
+        lambda: decode(netconf.Decoder(session), data),
+    )
+    # ncclient's session only provides the buffer and the dispatching
+    ncclient_session = SSHSession(DefaultDeviceHandler())
+    ncclient_session._base = base
+    ncclient_session._dispatch_message = messages.append
+    measure(
+        f"{label} decode ncclient",
+        lambda: decode(DefaultXMLParser(ncclient_session), data),
+    )
+    assert messages == [message] * 10
@@ -0,0 +1,76 @@
+"""Compare relaying a large proxied rpc-reply by reserializing and by streaming
+
+The reply resembles the running configuration of a large router. Each path
+runs in its own process, which reports its peak resident memory, because
+lxml allocates outside of tracemalloc. The client sink discards the framed
+data, like a fast channel.
+
+    PYTHONPATH=. python benchmarks/netconf_relay.py [megabytes]
+"""
+
+import resource
+import subprocess
+import sys
+import time
+
+from lxml import etree
+from ncclient.transport.session import BASE_NS_1_0, END_DELIM, NetconfBase
+
+from mb_netmgmt import netconf
+
+
+def create_reply(megabytes):
+    interface = (
+        "<interface><name>GigabitEthernet0/0/0/{}</name>"
+        "<description>uplink</description><mtu>9216</mtu>"
+        "<ipv4><address>10.0.0.1</address><netmask>255.255.255.252</netmask></ipv4>"
+        "</interface>"
+    )
+    count = megabytes * 2**20 // len(interface)
+    return (
+        f'<rpc-reply xmlns="{BASE_NS_1_0}" message-id="urn:uuid:1">\n'
+        "<data><interfaces>"
+        + "".join(interface.format(i) for i in range(count))
+        + "</interfaces></data></rpc-reply>"
+    )
+
+
+def reserialize(raw):
+    # the previous path: ncclient's parsed reply, pretty printed for mb,
+    # parsed and printed again with the message-id and framed by session.send
+    root = etree.fromstring(raw.encode())
+    del root.attrib["message-id"]
+    recorded = netconf.to_xml(root)
+    ele = etree.fromstring(recorded)
+    ele.set("message-id", "101")
+    data = netconf.to_xml(ele).encode()
+    return len(b"%s%s%s" % (b"\n#%i\n" % len(data), data, END_DELIM))
+
+
+def stream(raw):
+    etree.fromstring(raw.encode())  # still parsed by ncclient
+    recorded = netconf.remove_message_id(raw)
+    pieces = netconf.add_message_id(recorded, "101")
+    return sum(len(data) for data in netconf.frame(pieces, NetconfBase.BASE_11))
+
+
+def run(name, megabytes):
+    raw = create_reply(megabytes)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    size = globals()[name](raw)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    print(
+        f"{name:11} {len(raw) / 2**20:5.0f} MB reply, {size / 2**20:5.0f} MB sent, "
+        f"peak +{peak / 2**10:6.0f} MB, {elapsed:5.2f} s"
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        run(sys.argv[2], int(sys.argv[1]))
+    else:
+        megabytes = sys.argv[1] if len(sys.argv) > 1 else "100"
+        for name in ["reserialize", "stream"]:
+            subprocess.run([sys.executable, __file__, megabytes, name], check=True)
@@ -0,0 +1,58 @@
+"""Compare the memory used by recorded SNMP values as dicts and as OidStore
+
+The values resemble a walk of the interface tables of a large router. Both
+representations are built from JSON, like stubs received from mb.
+
+    PYTHONPATH=. python benchmarks/oid_store_memory.py [interfaces]
+"""
+
+import json
+import sys
+import time
+import tracemalloc
+
+from mb_netmgmt import ber
+from mb_netmgmt.oidstore import OidStore
+
+interfaces = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+columns = {
+    1: lambda i: {"val": i, "tag": "INTEGER"},
+    2: lambda i: {"val": f"GigabitEthernet0/0/{i // 48}/{i % 48}", "tag": "STRING"},
+    3: lambda i: {"val": 6, "tag": "INTEGER"},
+    4: lambda i: {"val": 1514, "tag": "INTEGER"},
+    5: lambda i: {"val": 1000000000, "tag": "GAUGE32"},
+    6: lambda i: {"val": "AAxDAQIDBA==", "tag": "STRING"},
+    7: lambda i: {"val": 1, "tag": "INTEGER"},
+    8: lambda i: {"val": 1, "tag": "INTEGER"},
+    9: lambda i: {"val": 123456789 + i, "tag": "TIME_TICKS"},
+    10: lambda i: {"val": 4294967295 - i, "tag": "COUNTER32"},
+}
+recording = json.dumps(
+    {
+        f"1.3.6.1.2.1.2.2.1.{column}.{i}": value(i)
+        for column, value in columns.items()
+        for i in range(1, interfaces + 1)
+    }
+)
+
+
+def measure(name, build):
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = build()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:8} {size / 2**20:6.1f} MB, peak {peak / 2**20:6.1f} MB, {elapsed:5.2f} s"
+    )
+    return result
+
+
+values = measure("dict", lambda: json.loads(recording))
+store = measure("OidStore", lambda: OidStore.from_values(json.loads(recording)))
+print(f"{len(values)} values")
+# values are compared encoded, as base64 strings of UTF-8 are decoded to text
+for oid, value in list(values.items())[::1000]:
+    assert ber.encode_value(store.get(oid)) == ber.encode_value(value)
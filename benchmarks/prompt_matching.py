@@ -0,0 +1,46 @@
+"""Measure CLI prompt detection throughput for large command outputs
+
+PYTHONPATH=. python benchmarks/prompt_matching.py [megabytes]
+"""
+
+import re
+import sys
+import time
+
+from mb_netmgmt.__main__ import PromptMatcher, get_cli_patterns
+
+line = b" ip address 192.0.2.1 255.255.255.0\r\n"
+
+
+def read_message(chunks, patterns):
+    matcher = PromptMatcher(patterns)
+    for chunk in chunks:
+        if matcher.feed(chunk):
+            break
+    return matcher.message()
+
+
+def read_message_rescanning(chunks, patterns):
+    message = b""
+    for chunk in chunks:
+        message += chunk
+        if any(re.findall(pattern, message) for pattern in patterns):
+            break
+    return message
+
+
+def throughput(read, size):
+    output = line * (size // len(line)) + b"\rRP/0/RSP0/CPU0:IOSXR-2#"
+    chunks = [output[i : i + 1024] for i in range(0, len(output), 1024)]
+    start = time.perf_counter()
+    assert read(chunks, get_cli_patterns()) == output
+    return len(output) / (time.perf_counter() - start) / 2**20
+
+
+if __name__ == "__main__":
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rate = throughput(read_message, int(megabytes * 2**20))
+    print(f"streaming, {megabytes} MB: {rate:.1f} MB/s")
+    # rescanning is quadratic, so it is only measured with a small output
+    rate = throughput(read_message_rescanning, 2**18)
+    print(f"rescanning, 0.25 MB: {rate:.1f} MB/s")
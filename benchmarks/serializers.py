@@ -0,0 +1,57 @@
+"""Compare dump and load times of the serializers for recorded imposters
+
+The recording holds CLI outputs of several lines, like a recorded telnet or
+ssh imposter. Serializers whose dependencies are not installed are skipped.
+
+    PYTHONPATH=. python benchmarks/serializers.py [stubs]
+"""
+
+import io
+import sys
+import time
+
+from mb_netmgmt import Json, LibYaml, Msgpack, RoundTripYaml
+
+stubs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+output = "\r\n".join(
+    f"GigabitEthernet0/0/0/{i}  up  up  10.0.{i // 256}.{i % 256}/31" for i in range(40)
+)
+recording = {
+    "imposters": [
+        {
+            "port": 23,
+            "protocol": "telnet",
+            "stubs": [
+                {
+                    "predicates": [{"deepEquals": {"command": f"show command {i}"}}],
+                    "responses": [{"is": {"response": output + f"\r\nrouter{i}#"}}],
+                }
+                for i in range(stubs)
+            ],
+        }
+    ]
+}
+
+
+def measure(serializer):
+    f = io.BytesIO() if serializer.binary else io.StringIO()
+    start = time.perf_counter()
+    serializer.dump(recording, f)
+    dumped = time.perf_counter()
+    f.seek(0)
+    serializer.load(f)
+    loaded = time.perf_counter()
+    size = len(f.getvalue()) / 2**20
+    print(
+        f"{type(serializer).__name__:14} dump {dumped - start:6.2f} s"
+        f"  load {loaded - dumped:6.2f} s  {size:6.1f} MB"
+    )
+
+
+for serializer_class in [RoundTripYaml, LibYaml, Json, Msgpack]:
+    try:
+        serializer = serializer_class()
+    except ImportError as e:
+        print(f"{serializer_class.__name__:14} skipped: {e}")
+        continue
+    measure(serializer)
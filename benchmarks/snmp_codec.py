@@ -0,0 +1,63 @@
+"""Compare SNMP packets per second of the BER codec and scapy
+
+Each packet is a GET request that is decoded and answered with a response
+of the same OIDs.
+
+    PYTHONPATH=. python benchmarks/snmp_codec.py [packets]
+"""
+
+import sys
+import time
+
+from scapy.layers.snmp import SNMP, SNMPget, SNMPvarbind
+
+from mb_netmgmt import ber, snmp
+
+oids = [f"1.3.6.1.2.1.2.2.1.{column}.1" for column in range(1, 11)]
+values = [
+    {"val": 1, "tag": "INTEGER"},
+    {"val": "GigabitEthernet0/0/0/1", "tag": "STRING"},
+    {"val": 6, "tag": "INTEGER"},
+    {"val": 1514, "tag": "INTEGER"},
+    {"val": 1000000000, "tag": "GAUGE32"},
+    {"val": "AAxDAQIDBA==", "tag": "STRING"},
+    {"val": 1, "tag": "INTEGER"},
+    {"val": 1, "tag": "INTEGER"},
+    {"val": 123456789, "tag": "TIME_TICKS"},
+    {"val": 4294967295, "tag": "COUNTER32"},
+]
+request = bytes(
+    SNMP(
+        community="public",
+        PDU=SNMPget(id=42, varbindlist=[SNMPvarbind(oid=oid) for oid in oids]),
+    )
+)
+
+
+def handle_ber(data):
+    message = ber.decode_message(data)
+    varbinds = [(oid, value) for (oid, _), value in zip(message.varbinds, values)]
+    response = ber.Message(
+        1, b"public", ber.RESPONSE, message.request_id, 0, 0, varbinds
+    )
+    return ber.encode_message(response)
+
+
+def handle_scapy(data):
+    message = snmp.from_scapy(SNMP(data))
+    varbinds = [(oid, value) for (oid, _), value in zip(message.varbinds, values)]
+    response = ber.Message(
+        1, b"public", ber.RESPONSE, message.request_id, 0, 0, varbinds
+    )
+    return bytes(snmp.to_scapy(response))
+
+
+if __name__ == "__main__":
+    packets = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    assert handle_ber(request) == handle_scapy(request)
+    for name, handle in [("scapy", handle_scapy), ("ber", handle_ber)]:
+        start = time.perf_counter()
+        for _ in range(packets):
+            handle(request)
+        rate = packets / (time.perf_counter() - start)
+        print(f"{name}: {rate:.0f} packets/s")
@@ -0,0 +1,55 @@
+"""Measure SSH connections per second with per-connection and cached host keys
+
+PYTHONPATH=. python benchmarks/ssh_connect.py [connections]
+"""
+
+import sys
+import time
+from threading import Thread
+from types import SimpleNamespace
+
+import paramiko
+
+from mb_netmgmt import ssh
+from mb_netmgmt.__main__ import create_server
+
+port = 8022
+
+
+class Handler(ssh.Handler):
+    def handle(self):
+        transport = ssh.start_server(
+            self.request, None, None, None, self.server.get_host_keys()
+        )
+        transport.accept(10)
+        transport.close()
+
+
+def connections_per_second(get_host_keys, connections):
+    server = create_server(
+        SimpleNamespace(Server=ssh.Server, Handler=Handler), port, None
+    )
+    server.get_host_keys = get_host_keys
+    Thread(target=server.serve_forever, daemon=True).start()
+    start = time.perf_counter()
+    for _ in range(connections):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
+        client.connect("localhost", port, "user", "password", look_for_keys=False)
+        client.close()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    return connections / elapsed
+
+
+if __name__ == "__main__":
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    server = SimpleNamespace(config={})
+    ssh.get_host_keys(server)
+    for name, get_host_keys in [
+        ("generated per connection", ssh.generate_host_keys),
+        ("cached per imposter", lambda: ssh.get_host_keys(server)),
+    ]:
+        rate = connections_per_second(get_host_keys, connections)
+        print(f"{name}: {rate:.2f} connections/s")
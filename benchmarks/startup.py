@@ -0,0 +1,43 @@
+"""Measure the import time of each protocol, which delays every imposter start
+
+Prints the median wall-clock time of importing the protocol module in a new
+interpreter, and the slowest imports reported by -X importtime.
+
+    PYTHONPATH=. python benchmarks/startup.py [runs]
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+
+def import_protocol(protocol, *options):
+    return subprocess.run(
+        [sys.executable, *options, "-c", f"import mb_netmgmt.{protocol}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+
+
+def slowest_imports(protocol, count=3):
+    lines = import_protocol(protocol, "-X", "importtime").stderr.splitlines()[1:]
+    imports = [line.split("|") for line in lines]
+    imports.sort(key=lambda fields: -int(fields[1]))
+    return ", ".join(
+        f"{name.strip()} {int(cumulative) / 1000:.0f} ms"
+        for _, cumulative, name in imports[1 : count + 1]
+    )
+
+
+for protocol in ["snmp", "telnet", "ssh", "netconf"]:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        import_protocol(protocol)
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times) * 1000
+    print(f"{protocol:8} {median:5.0f} ms  ({slowest_imports(protocol)})")
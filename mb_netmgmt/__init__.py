@@ -19,32 +19,67 @@
 
 """Network Management Protocols for Mountebank"""
 
+import atexit
+import gzip
+import hashlib
+import json
 import os
+import re
 import subprocess
 import time
 from contextlib import contextmanager
+from functools import lru_cache
 
 import requests
-from ruamel.yaml import YAML
-from ruamel.yaml.scalarstring import (
-    DoubleQuotedScalarString,
-    LiteralScalarString,
-    walk_tree,
-)
 
-yaml = YAML()
+# response fields of at least this size are stored once when deduplicating
+MIN_BLOB_SIZE = 64
+shared_mb = None
 
 
 @contextmanager
-def mb(imposters, loglevel="info"):
+def mb(imposters, loglevel="info", reuse=False, timeout=60):
+    """Runs Mountebank with the imposters
+
+    With reuse, an already running Mountebank is used, or one is started
+    and kept running for later calls. The imposters are added next to the
+    existing ones, and only they are deleted when the context is left."""
+    if reuse:
+        process = start_shared_mb(loglevel)
+        ports = []
+        try:
+            for imposter in imposters:
+                created = post_imposter("localhost", imposter, timeout=timeout)
+                ports.append(created["port"])
+            yield process
+        finally:
+            for port in ports:
+                requests.delete(f"http://localhost:2525/imposters/{port}")
+        return
     with start_mb(loglevel) as mb:
         try:
-            put_imposters("localhost", imposters)
+            put_imposters("localhost", imposters, timeout=timeout)
             yield mb
         finally:
             mb.terminate()
 
 
+def start_shared_mb(loglevel="info"):
+    global shared_mb
+    if shared_mb is None and not is_running("localhost"):
+        shared_mb = start_mb(loglevel)
+        atexit.register(shared_mb.terminate)
+    return shared_mb
+
+
+def is_running(host, port=2525):
+    try:
+        requests.get(f"http://{host}:{port}/config", timeout=1)
+        return True
+    except requests.RequestException:
+        return False
+
+
 def start_mb(loglevel="info"):
     mb_netmgmt_dir = os.path.dirname(__file__)
     return subprocess.Popen(
@@ -54,16 +89,41 @@ def start_mb(loglevel="info"):
     )
 
 
-def put_imposters(host, imposters, port=2525):
+def put_imposters(host, imposters, port=2525, timeout=60):
+    """Puts the imposters as soon as Mountebank accepts connections
+
+    Connection attempts are retried with exponential backoff from 10 ms to
+    500 ms, until timeout seconds have passed."""
+    url = f"http://{host}:{port}/imposters"
+    return send_when_running(
+        lambda: requests.put(url, json={"imposters": imposters}), host, port, timeout
+    )
+
+
+def post_imposter(host, imposter, port=2525, timeout=60):
+    """Adds the imposter, keeping the other imposters of Mountebank"""
+    url = f"http://{host}:{port}/imposters"
+    return send_when_running(
+        lambda: requests.post(url, json=imposter), host, port, timeout
+    )
+
+
+def send_when_running(send, host, port, timeout):
+    deadline = time.monotonic() + timeout
+    delay = 0.01
     while True:
         try:
-            response = requests.put(
-                f"http://{host}:{port}/imposters",
-                json={"imposters": imposters},
-            )
+            response = send()
             break
         except requests.ConnectionError:
-            time.sleep(1)
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Mountebank at {host}:{port} is not running")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+    return check_response(response)
+
+
+def check_response(response):
     try:
         response.raise_for_status()
         return response.json()
@@ -71,13 +131,25 @@ def put_imposters(host, imposters, port=2525):
         raise RuntimeError(e.response.json()["errors"])
 
 
-def dump_imposters(host="localhost", name="imposters", port=2525):
+def dump_imposters(host="localhost", name="imposters", port=2525, deduplicate=False):
     imposters = get_imposters(host, port)
-    use_scalar_strings(imposters)
-    yaml.dump(imposters, open(f"{name}.yaml", "w"))
+    if deduplicate:
+        imposters["blobs"] = dict()
+        for imposter in imposters["imposters"]:
+            for stub in imposter.get("stubs", []):
+                imposters["blobs"].update(
+                    deduplicate_stub(stub, imposters["blobs"].keys())
+                )
+    dump(imposters, recording_path(name))
 
 
 def use_scalar_strings(base):
+    from ruamel.yaml.scalarstring import (
+        DoubleQuotedScalarString,
+        LiteralScalarString,
+        walk_tree,
+    )
+
     walk_tree(
         base,
         {
@@ -100,7 +172,381 @@ def load_imposters(host, name):
 
 
 def read_imposters(name):
-    return yaml.load(open(f"{name}.yaml"))["imposters"]
+    imposters = load(recording_path(name))
+    blobs = imposters.get("blobs", {})
+    for imposter in imposters["imposters"]:
+        for stub in imposter.get("stubs", []):
+            resolve_stub(stub, blobs)
+    return imposters["imposters"]
+
+
+def deduplicate_stub(stub, known_blobs):
+    """Replaces large response fields by references to blobs
+
+    Returns the blobs that are not in known_blobs yet, by SHA-256 of their
+    JSON representation."""
+    blobs = dict()
+    for response in stub.get("responses", []):
+        fields = response.get("is", {})
+        for name, value in fields.items():
+            body = json.dumps(value, sort_keys=True)
+            if len(body) < MIN_BLOB_SIZE:
+                continue
+            digest = hashlib.sha256(body.encode()).hexdigest()
+            if digest not in known_blobs:
+                blobs[digest] = value
+            fields[name] = {"_blob": digest}
+    return blobs
+
+
+def resolve_stub(stub, blobs):
+    for response in stub.get("responses", []):
+        fields = response.get("is", {})
+        for name, value in fields.items():
+            if isinstance(value, dict) and list(value) == ["_blob"]:
+                fields[name] = blobs[value["_blob"]]
+
+
+def recording_path(name):
+    """Adds .yaml to names without a known file extension"""
+    if get_extension(name) in SERIALIZERS:
+        return name
+    return f"{name}.yaml"
+
+
+def export_imposters(path, host="localhost", port=2525, deduplicate=False):
+    """Writes the imposters to path one stub at a time
+
+    The format depends on the file extension, see SERIALIZERS. A .gz or
+    .zst suffix compresses the file. With deduplicate, each distinct large
+    response field is written once, before the first stub using it."""
+    with requests.Session() as session:
+        records = imposter_records(session, f"http://{host}:{port}")
+        if deduplicate:
+            records = deduplicate_records(records)
+        write_records(path, records)
+
+
+def imposter_records(session, url):
+    for summary in check_response(session.get(f"{url}/imposters"))["imposters"]:
+        imposter = check_response(
+            session.get(
+                f"{url}/imposters/{summary['port']}",
+                params={"replayable": True, "removeProxies": True},
+            )
+        )
+        stubs = imposter.pop("stubs", [])
+        yield {"imposter": imposter}
+        for stub in stubs:
+            yield {"stub": stub}
+
+
+def deduplicate_records(records):
+    known_blobs = set()
+    for record in records:
+        if "stub" in record:
+            for digest, body in deduplicate_stub(record["stub"], known_blobs).items():
+                known_blobs.add(digest)
+                yield {"blob": {"id": digest, "body": body}}
+        yield record
+
+
+def resolve_records(records):
+    blobs = dict()
+    for record in records:
+        if "blob" in record:
+            blobs[record["blob"]["id"]] = record["blob"]["body"]
+            continue
+        if "stub" in record:
+            resolve_stub(record["stub"], blobs)
+        yield record
+
+
+def import_imposters(path, host="localhost", port=2525, batch_size=100):
+    """Replaces the imposters with the ones exported to path
+
+    Each imposter is created with its first batch_size stubs, the other
+    stubs are added one by one, so that only one batch is held in memory."""
+    url = f"http://{host}:{port}/imposters"
+    with requests.Session() as session:
+        check_response(session.delete(url))
+        created = None
+        records = resolve_records(read_records(path))
+        for imposter, stubs in stub_batches(records, batch_size):
+            if imposter is not created:
+                check_response(session.post(url, json=dict(imposter, stubs=stubs)))
+                created = imposter
+                continue
+            for stub in stubs:
+                check_response(
+                    session.post(f"{url}/{imposter['port']}/stubs", json={"stub": stub})
+                )
+
+
+def stub_batches(records, batch_size):
+    imposter = None
+    stubs = []
+    for record in records:
+        if "imposter" in record:
+            if imposter is not None:
+                yield imposter, stubs
+            imposter, stubs = record["imposter"], []
+            continue
+        stubs.append(record["stub"])
+        if len(stubs) == batch_size:
+            yield imposter, stubs
+            stubs = []
+    if imposter is not None:
+        yield imposter, stubs
+
+
+def dump(data, path):
+    serializer = get_serializer(path)
+    with open_recording(path, "wb" if serializer.binary else "wt") as f:
+        serializer.dump(data, f)
+
+
+def load(path):
+    serializer = get_serializer(path)
+    with open_recording(path, "rb" if serializer.binary else "rt") as f:
+        return serializer.load(f)
+
+
+def write_records(path, records):
+    serializer = get_serializer(path)
+    with open_recording(path, "wb" if serializer.binary else "wt") as f:
+        serializer.dump_all(records, f)
+
+
+def read_records(path):
+    serializer = get_serializer(path)
+    with open_recording(path, "rb" if serializer.binary else "rt") as f:
+        yield from serializer.load_all(f)
+
+
+class RoundTripYaml:
+    binary = False
+
+    def dump(self, data, f):
+        use_scalar_strings(data)
+        get_yaml().dump(data, f)
+
+    def load(self, f):
+        return get_yaml().load(f)
+
+    def dump_all(self, documents, f):
+        get_yaml().dump_all(map(scalar_strings, documents), f)
+
+    def load_all(self, f):
+        return get_yaml().load_all(f)
+
+
+# the implicit types of YAML 1.2 as resolved by ruamel.yaml, which wrote the
+# existing recordings and leaves YAML 1.1 booleans like on or yes unquoted
+YAML_12_RESOLVERS = [
+    ("bool", r"^(?:true|True|TRUE|false|False|FALSE)$", "tTfF"),
+    (
+        "float",
+        r"""^(?:
+         [-+]?(?:[0-9][0-9_]*)\.[0-9_]*(?:[eE][-+]?[0-9]+)?
+        |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
+        |[-+]?\.[0-9_]+(?:[eE][-+][0-9]+)?
+        |[-+]?\.(?:inf|Inf|INF)
+        |\.(?:nan|NaN|NAN))$""",
+        "-+0123456789.",
+    ),
+    (
+        "int",
+        r"""^(?:[-+]?0b[0-1_]+
+        |[-+]?0o?[0-7_]+
+        |[-+]?[0-9_]+
+        |[-+]?0x[0-9a-fA-F_]+)$""",
+        "-+0123456789",
+    ),
+    ("merge", r"^(?:<<)$", "<"),
+    ("null", r"^(?: ~ |null|Null|NULL | )$", ["~", "n", "N", ""]),
+    (
+        "timestamp",
+        r"""^(?:[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]
+        |[0-9][0-9][0-9][0-9] -[0-9][0-9]? -[0-9][0-9]?
+        (?:[Tt]|[ \t]+)[0-9][0-9]?
+        :[0-9][0-9] :[0-9][0-9] (?:\.[0-9]*)?
+        (?:[ \t]*(?:Z|[-+][0-9][0-9]?(?::[0-9][0-9])?))?)$""",
+        "0123456789",
+    ),
+]
+
+
+class LibYaml:
+    """YAML using the C bindings of PyYAML
+
+    Plain scalars are resolved like YAML 1.2, the version of ruamel.yaml.
+    Strings that YAML 1.1 or 1.2 would resolve to another type are quoted,
+    and strings are styled like use_scalar_strings does."""
+
+    binary = False
+
+    def __init__(self):
+        import yaml as pyyaml
+
+        class Loader(pyyaml.CSafeLoader):
+            yaml_implicit_resolvers = {}
+
+        class Dumper(pyyaml.CSafeDumper):
+            pass
+
+        for tag, pattern, first in YAML_12_RESOLVERS:
+            for cls in [Loader, Dumper]:
+                cls.add_implicit_resolver(
+                    f"tag:yaml.org,2002:{tag}", re.compile(pattern, re.X), first
+                )
+        Loader.add_constructor("tag:yaml.org,2002:int", construct_int)
+        Dumper.add_representer(str, represent_str)
+        # scalar strings of ruamel.yaml
+        Dumper.add_multi_representer(str, represent_str)
+        self.pyyaml = pyyaml
+        self.loader = Loader
+        self.options = dict(Dumper=Dumper, allow_unicode=True, sort_keys=False)
+
+    def dump(self, data, f):
+        self.pyyaml.dump(data, f, **self.options)
+
+    def load(self, f):
+        return self.pyyaml.load(f, Loader=self.loader)
+
+    def dump_all(self, documents, f):
+        self.pyyaml.dump_all(documents, f, **self.options)
+
+    def load_all(self, f):
+        return self.pyyaml.load_all(f, Loader=self.loader)
+
+
+def construct_int(loader, node):
+    # YAML 1.2 has no sexagesimal integers, and 012 is decimal
+    value = loader.construct_scalar(node).replace("_", "")
+    sign = -1 if value.startswith("-") else 1
+    value = value.lstrip("-+")
+    for prefix, base in [("0b", 2), ("0o", 8), ("0x", 16)]:
+        if value.startswith(prefix):
+            return sign * int(value[2:], base)
+    return sign * int(value)
+
+
+def represent_str(dumper, value):
+    style = None
+    if "\r" in value:
+        style = '"'
+    elif "\n" in value:
+        style = "|"
+    return dumper.represent_scalar("tag:yaml.org,2002:str", str(value), style=style)
+
+
+class Json:
+    """JSON, with one document per line for several documents"""
+
+    binary = False
+
+    def dump(self, data, f):
+        json.dump(data, f)
+
+    def load(self, f):
+        return json.load(f)
+
+    def dump_all(self, documents, f):
+        for document in documents:
+            f.write(json.dumps(document) + "\n")
+
+    def load_all(self, f):
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class Msgpack:
+    binary = True
+
+    def __init__(self):
+        import msgpack
+
+        self.msgpack = msgpack
+
+    def dump(self, data, f):
+        self.msgpack.pack(data, f)
+
+    def load(self, f):
+        return self.msgpack.unpack(f)
+
+    def dump_all(self, documents, f):
+        for document in documents:
+            self.msgpack.pack(document, f)
+
+    def load_all(self, f):
+        return self.msgpack.Unpacker(f)
+
+
+@lru_cache(maxsize=None)
+def get_yaml():
+    from ruamel.yaml import YAML
+
+    return YAML()
+
+
+def __getattr__(name):
+    # ruamel.yaml is imported on first use, as imposters do not need it
+    if name == "yaml":
+        return get_yaml()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def yaml_serializer():
+    try:
+        return LibYaml()
+    except (ImportError, AttributeError):
+        # PyYAML is not installed or was built without libyaml
+        return RoundTripYaml()
+
+
+SERIALIZERS = {
+    ".yaml": yaml_serializer,
+    ".yml": yaml_serializer,
+    ".json": Json,
+    ".ndjson": Json,
+    ".msgpack": Msgpack,
+}
+
+
+def get_serializer(path):
+    try:
+        return SERIALIZERS[get_extension(path)]()
+    except KeyError:
+        raise ValueError(f"Unknown file format of {path}")
+
+
+def scalar_strings(record):
+    use_scalar_strings(record)
+    return record
+
+
+def get_extension(path):
+    return os.path.splitext(strip_compression(path))[1]
+
+
+def strip_compression(path):
+    path = str(path)
+    for suffix in [".gz", ".zst"]:
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+def open_recording(path, mode):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode)
+    if str(path).endswith(".zst"):
+        import zstandard
+
+        return zstandard.open(path, mode)
+    return open(path, mode)
 
 
 def proxy_imposters(to, snmp_port=161, telnet_port=23, netconf_port=830):
@@ -20,29 +20,115 @@
 import importlib
 import json
 import logging
+import os
+import re
+import signal
 import sys
 import tempfile
+import time
 import traceback
+from socket import SO_REUSEPORT, SOL_SOCKET
 from socketserver import BaseServer
+from threading import Lock
 from urllib.parse import urlparse
 
-import paramiko
 import requests
+from requests.adapters import HTTPAdapter
 
+upstream_pool_lock = Lock()
+# number of bytes before a received chunk that can still hold a prompt
+PROMPT_WINDOW = 512
 
-def create_server(protocol, port, callback_url):
+
+def create_server(protocol, port, callback_url, config=None, worker=0):
+    config = config or {}
     server_address = ("0.0.0.0", port)
-    server: BaseServer = protocol.Server(
+    server_class = protocol.Server
+    if config.get("asyncio"):
+        server_class = protocol.AsyncioServer
+    server: BaseServer = server_class(
         server_address, protocol.Handler, bind_and_activate=False
     )
     server.handle_error = handle_error
     server.callback_url = callback_url
+    server.config = config
+    server.worker = worker
+    server.session = create_session(server.config)
+    server.callback_timeout = server.config.get("callback_timeout")
+    server.proxy_cache = TimedCache(server.config.get("proxy_cache_ttl", 5))
+    # caches derived from the stubs, emptied when a proxy response adds one
+    server.stub_caches = [server.proxy_cache]
     server.allow_reuse_address = True
+    if config.get("workers", 1) > 1:
+        server.socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     server.server_bind()
     server.server_activate()
     return server
 
 
+def start_workers(server, protocol, port, callback_url, config):
+    """Forks a process per additional worker, each with its own server
+
+    The servers bind the same port with SO_REUSEPORT, so that the kernel
+    distributes the requests across the processes."""
+    # loaded before forking, so that all workers present the same host keys
+    if hasattr(protocol, "get_host_keys"):
+        protocol.get_host_keys(server)
+    pids = []
+    for worker in range(1, config.get("workers", 1)):
+        pid = os.fork()
+        if pid == 0:
+            server.socket.close()
+            for handler in logging.getLogger().handlers:
+                handler.setFormatter(
+                    logging.Formatter(f"worker {worker}: {logging.BASIC_FORMAT}")
+                )
+            status = 0
+            try:
+                worker_server = create_server(
+                    protocol, port, callback_url, config, worker
+                )
+                if hasattr(server, "host_keys"):
+                    worker_server.host_keys = server.host_keys
+                serve(worker_server)
+            except SystemExit:
+                pass
+            except Exception:
+                logging.exception("Worker %s failed", worker)
+                status = 1
+            os._exit(status)
+        pids.append(pid)
+    return pids
+
+
+def stop_workers(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def serve(server):
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def create_session(config):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=config.get("callback_pool_size", 10)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def handle_error(request, client_address):
     line = "-" * 40
     logging.error(
@@ -71,10 +157,12 @@ class Protocol:
             return self.post_proxy_response(mb_response, proxy_response)
 
     def post_proxy_response(self, mb_response, proxy_response):
-        response = requests.post(
-            mb_response["callbackURL"], json={"proxyResponse": proxy_response}
+        response = self.request_mb(
+            "POST", mb_response["callbackURL"], json={"proxyResponse": proxy_response}
         )
         response.raise_for_status()
+        for cache in getattr(self.server, "stub_caches", []):
+            cache.invalidate()
         return response.json()
 
     def send_upstream(self, request, request_id):
@@ -87,44 +175,165 @@ class Protocol:
         raise NotImplementedError
 
     def post_request(self, request):
-        response = requests.post(
+        response = self.request_mb(
+            "POST",
             self.callback_url,
             json={"request": request},
         )
         response.raise_for_status()
         return response.json()
 
+    def load_stubs(self):
+        imposter_response = self.request_mb(
+            "GET",
+            self.callback_url.replace("/_requests", ""),
+            params={"replayable": True},
+        )
+        return imposter_response.json()["stubs"]
+
+    def request_mb(self, method, url, **kwargs):
+        session = getattr(self.server, "session", requests)
+        timeout = getattr(self.server, "callback_timeout", None)
+        return session.request(method, url, timeout=timeout, **kwargs)
+
     def get_to(self):
         self.key_filename = None
+        self.proxy = self.get_proxy_config()
+        if self.proxy:
+            self.save_key(self.proxy)
+            disable_algorithms(self.proxy.get("disabled_algorithms", {}))
+            return parse_to(self.proxy["to"])
+
+    def get_proxy_config(self):
+        proxy_cache = getattr(self.server, "proxy_cache", None)
+        if proxy_cache is None:
+            return self.load_proxy_config()
+        return proxy_cache.get(self.load_proxy_config)
+
+    def load_proxy_config(self):
         try:
-            imposter_response = requests.get(
-                self.server.callback_url.replace("/_requests", "")
+            imposter_response = self.request_mb(
+                "GET", self.server.callback_url.replace("/_requests", "")
             )
             stubs = imposter_response.json()["stubs"]
             proxy = self.get_proxy(stubs[-1])
             if not proxy:
                 proxy = self.get_proxy(stubs[0])
-            if proxy:
-                self.save_key(proxy)
-                disable_algorithms(proxy.get("disabled_algorithms", {}))
-                return parse_to(proxy["to"])
         except (IndexError, AttributeError):
-            pass
+            return None
+        if proxy:
+            config = {
+                key: proxy[key]
+                for key in ["to", "key", "disabled_algorithms", "timeout"]
+                if key in proxy
+            }
+            if config.get("key"):
+                # written once per cached proxy configuration, under its lock
+                config["keyfile"] = tempfile.NamedTemporaryFile("w")
+                config["keyfile"].write(config["key"])
+                config["keyfile"].flush()
+            return config
 
     def save_key(self, proxy):
-        key = proxy.get("key")
-        if key:
-            self.keyfile = tempfile.NamedTemporaryFile("w")
-            self.keyfile.write(key)
-            self.keyfile.flush()
-            self.key_filename = self.keyfile.name
-        else:
-            self.key_filename = None
+        keyfile = proxy.get("keyfile")
+        self.key_filename = keyfile.name if keyfile else None
 
     def get_proxy(self, stub):
         return stub["responses"][0].get("proxy")
 
 
+class TimedCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.invalidate()
+
+    def get(self, load):
+        with self.lock:
+            if time.monotonic() >= self.expires:
+                self.value = load()
+                self.expires = time.monotonic() + self.ttl
+            return self.value
+
+    def invalidate(self):
+        self.value = None
+        self.expires = float("-inf")
+
+
+class ConnectionPool:
+    def __init__(self, max_size, idle_timeout, health_check, is_alive, close):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.is_alive = is_alive
+        self.close = close
+        self.lock = Lock()
+        self.idle = {}
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, key, connect):
+        connection = None
+        stale = []
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections and connection is None:
+                candidate, released = connections.pop()
+                if self.is_usable(candidate, released):
+                    connection = candidate
+                    self.hits += 1
+                else:
+                    stale.append(candidate)
+            if connection is None:
+                self.misses += 1
+        for candidate in stale:
+            self.close(candidate)
+        logging.debug("upstream pool: %s", self.metrics())
+        if connection is None:
+            connection = connect()
+        return connection
+
+    def release(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_size:
+                connections.append((connection, time.monotonic()))
+                return
+        self.close(connection)
+
+    def is_usable(self, connection, released):
+        if time.monotonic() - released > self.idle_timeout:
+            return False
+        return not self.health_check or self.is_alive(connection)
+
+    def metrics(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def get_upstream_pool(server, is_alive, close):
+    config = getattr(server, "config", {})
+    if not config.get("upstream_pool_size"):
+        return None
+    with upstream_pool_lock:
+        if not hasattr(server, "upstream_pool"):
+            server.upstream_pool = ConnectionPool(
+                config["upstream_pool_size"],
+                config.get("upstream_idle_timeout", 300),
+                config.get("upstream_health_check", True),
+                is_alive,
+                close,
+            )
+        return server.upstream_pool
+
+
+def upstream_key(to, key_filename):
+    key = None
+    if key_filename:
+        with open(key_filename) as f:
+            key = f.read()
+    return to.hostname, to.port, to.username, key
+
+
 def parse_to(url: str):
     to = urlparse(url)
     if not to.hostname:
@@ -132,30 +341,79 @@ def parse_to(url: str):
     return to
 
 
+# more specific prompts come first, as the first matching alternative
+# determines the prompt class
+CLI_PATTERNS = {
+    # based on IOS XR driver of Exscript
+    "ios_xr": rb"[\r\n\x00\x1b\[K]RP/\d+/(?:RS?P)?\d+\/CPU\d+:[^#]+(?:\([^\)]+\))?#$",
+    # based on IOS driver of Exscript
+    "ios": rb"[\r\n\x1b\[K][\-\w+\.:/]+(?:\([^\)]+\))?[>#] ?$",
+    # Interactive prompt
+    "interactive": rb'[\r\n\x00\x1b\[K]+(?P<text>[A-Z][\w\/ .:,>\(\)\-\?"]*[^A-Z])(?P<default>\[[\w\/.,():\-]*\])?(?(default)(?P<end1>(?:\?|: ?| |)$)|(?P<end2>: $))',
+    # Terminal paging
+    "more": rb"[\r\n\x00\x1b\[K] --More-- $",
+    # unix shell inside IOS XR
+    "xr_shell": rb"[\r\n\x00\x1b\[K]\[(?:[a-z-]*_)?node\d_RS?P\d_CPU\d:(?P<path>[~\.\/\w-]+)\]\$$",
+}
+# the lookahead lets re skip positions where no prompt can start
+CLI_PROMPT = re.compile(
+    rb"(?=[\r\n\x00\x1b\[K])(?:"
+    + b"|".join(
+        b"(?P<%s>%s)" % (name.encode(), pattern)
+        for name, pattern in CLI_PATTERNS.items()
+    )
+    + b")"
+)
+
+
 def get_cli_patterns():
-    patterns = []
-    patterns.append(
-        b"[\r\n\x1b\[K][\-\w+\.:/]+(?:\([^\)]+\))?[>#] ?$"
-    )  # based on IOS driver of Exscript
-    patterns.append(
-        b"[\r\n\x00\x1b\[K]RP/\d+/(?:RS?P)?\d+\/CPU\d+:[^#]+(?:\([^\)]+\))?#$"
-    )  # based on IOS XR driver of Exscript
-    patterns.append(
-        b'[\r\n\x00\x1b\[K]+(?P<text>[A-Z][\w\/ .:,>\(\)\-\?"]*[^A-Z])(?P<default>\[[\w\/.,():\-]*\])?(?(default)(?P<end1>(?:\?|: ?| |)$)|(?P<end2>: $))'
-    )  # Interactive prompt
-    patterns.append(b"[\r\n\x00\x1b\[K] --More-- $")  # Terminal paging
-    patterns.append(b"[\r\n\x00\x1b\[K]\[(?:[a-z-]*_)?node\d_RS?P\d_CPU\d:(?P<path>[~\.\/\w-]+)\]\$$")  # unix shell inside IOS XR
-    return patterns
+    return list(CLI_PATTERNS.values())
+
+
+def match_cli_prompt(message, pos=0):
+    # all prompts are anchored at the end of the message
+    pos = max(pos, len(message) - PROMPT_WINDOW)
+    match = CLI_PROMPT.search(message, pos)
+    if match:
+        return match.lastgroup
+
+
+class PromptMatcher:
+    def __init__(self, patterns):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.buffer = bytearray()
+        self.match = None
+
+    def feed(self, chunk):
+        start = max(0, len(self.buffer) - PROMPT_WINDOW)
+        self.buffer += chunk
+        for pattern in self.patterns:
+            self.match = pattern.search(self.buffer, start)
+            if self.match:
+                return True
+        return False
+
+    def message(self):
+        return bytes(self.buffer)
 
 
 def disable_algorithms(disabled_algorithms):
+    # imported here, as only ssh and netconf imposters need paramiko
+    import paramiko
+
     # https://github.com/ncclient/ncclient/issues/526#issuecomment-1096563028
-    class MonkeyPatchedTransport(paramiko.Transport):
-        def __init__(self, *args, **kwargs):
-            kwargs["disabled_algorithms"] = disabled_algorithms
-            super().__init__(*args, **kwargs)
+    # patched once, so that repeated calls do not nest subclasses
+    if not hasattr(paramiko.Transport, "default_disabled_algorithms"):
+
+        class MonkeyPatchedTransport(paramiko.Transport):
+            default_disabled_algorithms = {}
+
+            def __init__(self, *args, **kwargs):
+                kwargs["disabled_algorithms"] = self.default_disabled_algorithms
+                super().__init__(*args, **kwargs)
 
-    paramiko.Transport = MonkeyPatchedTransport
+        paramiko.Transport = MonkeyPatchedTransport
+    paramiko.Transport.default_disabled_algorithms = disabled_algorithms
 
 
 if __name__ == "__main__":
@@ -167,6 +425,10 @@ if __name__ == "__main__":
     callback_url = args["callbackURLTemplate"].replace(":port", str(port))
     logging.basicConfig(level=args["loglevel"].upper())
 
-    server = create_server(protocol, port, callback_url)
+    server = create_server(protocol, port, callback_url, args)
+    workers = start_workers(server, protocol, port, callback_url, args)
     print(protocol_name, flush=True)
-    server.serve_forever()
+    try:
+        serve(server)
+    finally:
+        stop_workers(workers)
@@ -0,0 +1,264 @@
+# This file is part of the project mb-netmgmt
+#
+# (C) 2022 Deutsche Telekom AG
+#
+# Deutsche Telekom AG and all other contributors / copyright
+# owners license this file to you under the terms of the GPL-2.0:
+#
+# mb-netmgmt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+#
+# mb-netmgmt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mb-netmgmt. If not, see <https://www.gnu.org/licenses/
+
+"""BER codec for the subset of SNMPv1/v2c used by the snmp protocol
+
+Values use the same JSON representation as snmp.to_dict and snmp.to_varbind
+and are encoded to the same bytes as scapy. Anything outside of the subset
+raises UnsupportedError, so that the caller can fall back to scapy."""
+
+import socket
+from base64 import b64decode, b64encode
+from collections import namedtuple
+
+SEQUENCE = 0x30
+GET = 0xA0
+GETNEXT = 0xA1
+RESPONSE = 0xA2
+SET = 0xA3
+GETBULK = 0xA5
+PDU_TYPES = [GET, GETNEXT, RESPONSE, SET, GETBULK]
+
+INTEGER_TAGS = {
+    0x02: "INTEGER",
+    0x41: "COUNTER32",
+    0x42: "GAUGE32",
+    0x43: "TIME_TICKS",
+    0x46: "COUNTER64",
+}
+TAGS = {0x04: "STRING", 0x05: "NULL", 0x06: "OID", 0x40: "IPADDRESS", **INTEGER_TAGS}
+TAG_NUMBERS = {name: number for number, name in TAGS.items()}
+EXCEPTIONS = {0x80: "noSuchObject", 0x81: "noSuchInstance", 0x82: "endOfMibView"}
+EXCEPTION_NUMBERS = {name: number for number, name in EXCEPTIONS.items()}
+
+# error_status and error_index hold non-repeaters and max-repetitions for
+# GETBULK requests
+Message = namedtuple(
+    "Message",
+    "version community pdu_type request_id error_status error_index varbinds",
+)
+
+
+class UnsupportedError(ValueError):
+    pass
+
+
+def decode_message(data):
+    data = memoryview(data)
+    tag, pos, end = read_header(data, 0)
+    if tag != SEQUENCE or end != len(data):
+        raise UnsupportedError("Not an SNMP message")
+    version, pos = read_integer(data, pos)
+    community, pos = read_value(data, pos, 0x04)
+    pdu_type, pos, end = read_header(data, pos)
+    if pdu_type not in PDU_TYPES or end != len(data):
+        raise UnsupportedError(f"Unsupported PDU type {pdu_type:#x}")
+    request_id, pos = read_integer(data, pos)
+    error_status, pos = read_integer(data, pos)
+    error_index, pos = read_integer(data, pos)
+    tag, pos, end = read_header(data, pos)
+    if tag != SEQUENCE or end != len(data):
+        raise UnsupportedError("Invalid varbind list")
+    varbinds = []
+    while pos < end:
+        tag, pos, varbind_end = read_header(data, pos)
+        if tag != SEQUENCE:
+            raise UnsupportedError("Invalid varbind")
+        oid, pos = read_value(data, pos, 0x06)
+        tag, pos, value_end = read_header(data, pos)
+        if value_end != varbind_end:
+            raise UnsupportedError("Invalid varbind")
+        varbinds.append((decode_oid(oid), decode_value(tag, data[pos:value_end])))
+        pos = value_end
+    return Message(
+        version,
+        bytes(community),
+        pdu_type,
+        request_id,
+        error_status,
+        error_index,
+        varbinds,
+    )
+
+
+def encode_message(message):
+    return encode_envelope(message, encode_body(message))
+
+
+def encode_body(message):
+    """Encodes the part of the PDU after the request id"""
+    varbinds = b"".join(encode_varbind(oid, value) for oid, value in message.varbinds)
+    return (
+        encode_integer(0x02, message.error_status)
+        + encode_integer(0x02, message.error_index)
+        + encode_tlv(SEQUENCE, varbinds)
+    )
+
+
+def encode_envelope(message, body):
+    pdu = encode_integer(0x02, message.request_id) + body
+    return encode_tlv(
+        SEQUENCE,
+        encode_integer(0x02, message.version)
+        + encode_tlv(0x04, message.community)
+        + encode_tlv(message.pdu_type, pdu),
+    )
+
+
+def encode_varbind(oid, response):
+    return encode_tlv(
+        SEQUENCE, encode_tlv(0x06, encode_oid(oid)) + encode_value(response)
+    )
+
+
+def encode_value(response):
+    value = response["val"]
+    tag = response["tag"]
+    exceptions = set(response) - {"val", "tag"}
+    if exceptions:
+        if value is not None or tag is not None or len(exceptions) != 1:
+            raise UnsupportedError(f"Unsupported value {response}")
+        return bytes([EXCEPTION_NUMBERS[exceptions.pop()], 0])
+    # the same base64 handling as snmp.to_varbind
+    try:
+        value = b64decode(value, validate=True)
+    except (ValueError, TypeError):
+        pass
+    if tag not in TAG_NUMBERS:
+        raise UnsupportedError(f"Unsupported tag {tag}")
+    number = TAG_NUMBERS[tag]
+    if number in INTEGER_TAGS and isinstance(value, int):
+        return encode_integer(number, value)
+    if tag == "STRING" and isinstance(value, str):
+        return encode_tlv(number, value.encode())
+    if tag == "STRING" and isinstance(value, bytes):
+        return encode_tlv(number, value)
+    if tag == "NULL" and value == 0:
+        return bytes([number, 0])
+    if tag == "OID" and isinstance(value, bytes):
+        value = value.decode()
+    if tag == "OID" and isinstance(value, str):
+        return encode_tlv(number, encode_oid(value))
+    if tag == "IPADDRESS" and isinstance(value, str):
+        try:
+            return encode_tlv(number, socket.inet_aton(value))
+        except OSError:
+            pass
+    raise UnsupportedError(f"Unsupported value {response}")
+
+
+def decode_value(tag, content):
+    if tag in EXCEPTIONS and not content:
+        return {"val": None, "tag": None, EXCEPTIONS[tag]: 0}
+    if tag in INTEGER_TAGS and content:
+        return {"val": int.from_bytes(content, "big", signed=True), "tag": TAGS[tag]}
+    if tag == 0x04:
+        return {"val": decode_string(bytes(content)), "tag": "STRING"}
+    if tag == 0x05 and not content:
+        return {"val": 0, "tag": "NULL"}
+    if tag == 0x06:
+        return {"val": decode_oid(content), "tag": "OID"}
+    if tag == 0x40 and len(content) == 4:
+        return {"val": socket.inet_ntoa(content), "tag": "IPADDRESS"}
+    raise UnsupportedError(f"Unsupported value type {tag:#x}")
+
+
+def decode_string(value):
+    # the same representation as snmp.decode
+    try:
+        return value.decode()
+    except UnicodeDecodeError:
+        return b64encode(value).decode()
+
+
+def encode_oid(oid):
+    arcs = [int(arc) for arc in oid.strip(".").split(".")]
+    if len(arcs) < 2:
+        raise UnsupportedError(f"Unsupported OID {oid}")
+    result = bytearray()
+    for arc in [arcs[0] * 40 + arcs[1]] + arcs[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.append(arc & 0x7F | 0x80)
+            arc >>= 7
+        result += bytes(reversed(chunk))
+    return bytes(result)
+
+
+def decode_oid(content):
+    arcs = []
+    arc = 0
+    for byte in content:
+        arc = arc << 7 | byte & 0x7F
+        if not byte & 0x80:
+            arcs.append(arc)
+            arc = 0
+    if not arcs or content[-1] & 0x80:
+        raise UnsupportedError("Invalid OID")
+    # scapy splits the first sub-identifier without limiting it to 2
+    arcs[:1] = divmod(arcs[0], 40)
+    return ".".join(map(str, arcs))
+
+
+def encode_integer(tag, value):
+    length = max(value, ~value).bit_length() // 8 + 1
+    return encode_tlv(tag, value.to_bytes(length, "big", signed=True))
+
+
+def read_integer(data, pos):
+    content, pos = read_value(data, pos, 0x02)
+    if not content:
+        raise UnsupportedError("Invalid integer")
+    return int.from_bytes(content, "big", signed=True), pos
+
+
+def read_value(data, pos, expected_tag):
+    tag, start, end = read_header(data, pos)
+    if tag != expected_tag:
+        raise UnsupportedError(f"Expected tag {expected_tag:#x}, got {tag:#x}")
+    return data[start:end], end
+
+
+def read_header(data, pos):
+    try:
+        tag = data[pos]
+        length = data[pos + 1]
+        pos += 2
+        if length & 0x80:
+            size = length & 0x7F
+            length = int.from_bytes(data[pos : pos + size], "big")
+            if size == 0 or pos + size > len(data):
+                raise UnsupportedError("Invalid length")
+            pos += size
+    except IndexError:
+        raise UnsupportedError("Truncated message")
+    if pos + length > len(data):
+        raise UnsupportedError("Truncated message")
+    return tag, pos, pos + length
+
+
+def encode_tlv(tag, content):
+    length = len(content)
+    if length < 0x80:
+        header = bytes([tag, length])
+    else:
+        size = (length.bit_length() + 7) // 8
+        header = bytes([tag, 0x80 | size]) + length.to_bytes(size, "big")
+    return header + content
@@ -17,16 +17,24 @@
 # You should have received a copy of the GNU General Public License
 # along with mb-netmgmt. If not, see <https://www.gnu.org/licenses/
 
+import hashlib
 import logging
-from socketserver import BaseRequestHandler
-from socketserver import ThreadingTCPServer as Server
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+from threading import BoundedSemaphore, Lock, local
+from xml.sax.saxutils import escape, quoteattr
 
 from lxml import etree
 from ncclient.devices.default import DefaultDeviceHandler
 from ncclient.manager import connect
-from ncclient.transport.parser import DefaultXMLParser
+from ncclient.operations import Dispatch, TimeoutExpiredError
+from ncclient.transport.errors import NetconfFramingError
 from ncclient.transport.session import (
     BASE_NS_1_0,
+    END_DELIM,
     MSG_DELIM,
     HelloHandler,
     NetconfBase,
@@ -37,38 +45,78 @@ from ncclient.transport.session import (
 )
 from ncclient.transport.ssh import PORT_NETCONF_DEFAULT, SSHSession
 
-from mb_netmgmt.__main__ import Protocol
-from mb_netmgmt.ssh import start_server
+from mb_netmgmt.__main__ import (
+    Protocol,
+    TimedCache,
+    get_upstream_pool,
+    upstream_key,
+)
+from mb_netmgmt.ssh import get_host_keys, start_server
 
 stopped = False
+local_stubs_lock = Lock()
+hello_cache_lock = Lock()
 NETCONF_11 = "urn:ietf:params:netconf:base:1.1"
+CHUNK_SIZE = 2**16
+# chunk-size is at most 4294967295, so a chunk header has at most 13 bytes
+MAX_CHUNK_HEADER = 13
+# the first start tag, skipping the XML declaration, comments and the like
+ROOT_TAG = re.compile(
+    r"""<[^?!][^\s/>]*(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*/?>"""
+)
+MESSAGE_ID = re.compile(r"""\s+message-id\s*=\s*(?:"[^"]*"|'[^']*')""")
+# operations without side effects, whose replies can be answered locally
+READ_OPERATIONS = ["get", "get-config"]
+
+
+class Server(ThreadingTCPServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sessions = count()
+
+    def next_session_id(self):
+        # unique across the worker processes serving the port
+        workers = getattr(self, "config", {}).get("workers", 1)
+        return next(self.sessions) * workers + getattr(self, "worker", 0) + 1
 
 
 class Handler(BaseRequestHandler, Protocol):
     def setup(self):
         session = SSHSession(DefaultDeviceHandler())
-        session.add_listener(Listener(super().handle_request))
-        self.parser = DefaultXMLParser(session)
+        session.add_listener(Listener(self.dispatch))
+        session.parser = Decoder(session)
         self.session = session
-        self.original_transport_read = self.session._transport_read
-        self.session._transport_read = self.transport_read
+        # the upstream RPC of the request handled by the current thread
+        self.upstream = local()
+        self.manager_lock = Lock()
+        self.executor = None
+        rpc_workers = getattr(self.server, "config", {}).get("rpc_workers", 1)
+        if rpc_workers > 1:
+            self.executor = ThreadPoolExecutor(rpc_workers)
+            self.slots = BoundedSemaphore(rpc_workers)
+            self.replies = deque()
+            self.write_lock = Lock()
 
     def handle(self):
         self.callback_url = self.server.callback_url
+        self.to = self.get_to()
         transport = start_server(
-            self.request, self.get_to(), self.key_filename, self.handle_request
+            self.request,
+            self.to,
+            self.key_filename,
+            self.handle_request,
+            get_host_keys(self.server),
         )
         self.channel = transport.accept()
         self.session._transport = transport
         self.session._channel = self.channel
         self.session._connected = True
 
-        self.open_upstream()
         self.handle_prompt()
         self.session.run()
 
     def open_upstream(self):
-        to = self.get_to()
+        to = self.to
         if not to:
             return
         timeout = getattr(to, "timeout", None)
@@ -80,17 +128,66 @@ class Handler(BaseRequestHandler, Protocol):
             timeout = 60
         else:
             timeout = int(timeout)
-        self.manager = connect(
-            host=to.hostname,
-            port=to.port or PORT_NETCONF_DEFAULT,
-            username=to.username,
-            password=to.password,
-            key_filename=self.key_filename,
-            hostkey_verify=False,
-            timeout=timeout,
-        )
+        self.upstream_pool = get_upstream_pool(self.server, is_alive, close)
+        self.upstream_key = upstream_key(to, self.key_filename)
+
+        def connect_upstream():
+            return connect(
+                host=to.hostname,
+                port=to.port or PORT_NETCONF_DEFAULT,
+                username=to.username,
+                password=to.password,
+                key_filename=self.key_filename,
+                hostkey_verify=False,
+                timeout=timeout,
+            )
+
+        if self.upstream_pool:
+            self.manager = self.upstream_pool.acquire(
+                self.upstream_key, connect_upstream
+            )
+        else:
+            self.manager = connect_upstream()
+
+    def finish(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+        manager = getattr(self, "manager", None)
+        if not manager:
+            return
+        if self.upstream_pool:
+            self.upstream_pool.release(self.upstream_key, manager)
+        else:
+            close(manager)
+
+    def get_manager(self):
+        # the upstream session is only opened once an RPC is proxied
+        with self.manager_lock:
+            if not hasattr(self, "manager"):
+                self.open_upstream()
+            return getattr(self, "manager", None)
 
     def handle_prompt(self):
+        hello = get_hello_cache(self.server).get(self.load_hello)
+        self.session_id = self.server.next_session_id()
+        self.channel.sendall(hello.to_bytes(self.session_id))
+
+        def init_cb(id, client_capabilities):
+            if NETCONF_11 in client_capabilities and NETCONF_11 in hello.capabilities:
+                self.session._base = NetconfBase.BASE_11
+
+        self.session.add_listener(HelloHandler(init_cb, lambda ex: None))
+
+    def handle_request(self, request, request_id):
+        local_stubs = get_local_stubs(self.server)
+        if local_stubs:
+            response = local_stubs.match(request, self.load_stubs)
+            if response is not None:
+                local_stubs.report(self.post_request, request)
+                return self.respond(response, request_id)
+        return super().handle_request(request, request_id)
+
+    def load_hello(self):
         mb_response = self.post_request({"rpc": ""})
         try:
             response = mb_response["response"]
@@ -98,42 +195,74 @@ class Handler(BaseRequestHandler, Protocol):
                 response = DefaultDeviceHandler._BASE_CAPABILITIES
         except KeyError:
             try:
-                capabilities = [c for c in self.manager.server_capabilities]
+                capabilities = [c for c in self.get_manager().server_capabilities]
             except AttributeError:
                 capabilities = DefaultDeviceHandler._BASE_CAPABILITIES
             response = self.post_proxy_response(mb_response, capabilities)
-        hello = to_ele(HelloHandler.build(response, None))
+        return Hello(response)
 
-        # A server sending the <hello> element MUST include a <session-id>
-        # element containing the session ID for this NETCONF session.
-        # https://datatracker.ietf.org/doc/html/rfc6241#section-8.1
-        session_id = sub_ele(hello, "session-id")
-        session_id.text = "1"
+    def dispatch(self, request, message_id):
+        if not self.executor:
+            self.write(self.handle_rpc(request, message_id))
+            return
+        # blocks reading further RPCs of the session while all workers are busy
+        self.slots.acquire()
+        future = self.executor.submit(self.handle_pipelined, request, message_id)
+        with self.write_lock:
+            self.replies.append(future)
+        future.add_done_callback(self.write_replies)
 
-        self.channel.sendall(to_xml(hello) + MSG_DELIM.decode())
+    def handle_pipelined(self, request, message_id):
+        try:
+            return self.handle_rpc(request, message_id)
+        finally:
+            self.slots.release()
 
-        def init_cb(id, client_capabilities):
-            if NETCONF_11 in client_capabilities and NETCONF_11 in response:
-                self.session._base = NetconfBase.BASE_11
+    def handle_rpc(self, request, message_id):
+        # the client waits for a reply to each message-id, even if it failed
+        try:
+            return self.handle_request(request, message_id)
+        except Exception as e:
+            logging.exception("Failed to handle RPC")
+            return add_message_id(rpc_error(str(e) or type(e).__name__), message_id)
 
-        self.session.add_listener(HelloHandler(init_cb, lambda ex: None))
+    def write_replies(self, done):
+        # replies are written in the order of the requests
+        with self.write_lock:
+            while self.replies and self.replies[0].done():
+                future = self.replies.popleft()
+                if future.cancelled():
+                    continue
+                try:
+                    self.write(future.result())
+                except Exception:
+                    logging.exception("Failed to write rpc-reply")
 
     def read_proxy_response(self):
-        return {"rpc-reply": remove_message_id(self.rpc_reply._root)}
+        rpc = self.upstream.rpc
+        if not rpc.event.wait(rpc.timeout):
+            raise TimeoutExpiredError("Timed out waiting for the upstream rpc-reply")
+        if rpc.error:
+            raise rpc.error
+        return {"rpc-reply": remove_message_id(rpc.reply.xml)}
 
     def send_upstream(self, request, request_id):
-        self.rpc_reply = self.manager.rpc(to_ele(request["rpc"]))
+        # asynchronous, so that pipelined RPCs are pipelined upstream as well
+        manager = self.get_manager()
+        self.upstream.rpc = Dispatch(
+            manager._session,
+            device_handler=manager._device_handler,
+            async_mode=True,
+            timeout=manager.timeout,
+        ).request(to_ele(request["rpc"]))
 
     def respond(self, response, request_id):
         reply = response.get("rpc-reply", f'<rpc-reply xmlns="{BASE_NS_1_0}"/>')
-        message = add_message_id(reply, request_id)
-        self.session.send(message)
+        return add_message_id(reply, request_id)
 
-    def transport_read(self):
-        result = self.original_transport_read()
-        if result.startswith(b"#"):
-            return b"\n" + result
-        return result
+    def write(self, pieces):
+        for data in frame(pieces, self.session._base):
+            self.channel.sendall(data)
 
 
 class Listener(SessionListener):
@@ -145,22 +274,272 @@ class Listener(SessionListener):
         if (tag == qualify("hello")) or (tag == "hello"):
             return
         ele = etree.fromstring(raw.encode())
-        request = {"rpc": to_xml(ele[0])}
+        request = {"rpc": to_xml(ele[0]), "fingerprint": fingerprint(ele[0])}
         self.handle_request(request, attrs["message-id"])
 
     def errback(self, ex):
         logging.exception(ex)
 
 
+class Hello:
+    """The hello of an imposter, serialized once for all of its sessions"""
+
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        hello = to_ele(HelloHandler.build(capabilities, None))
+
+        # A server sending the <hello> element MUST include a <session-id>
+        # element containing the session ID for this NETCONF session.
+        # https://datatracker.ietf.org/doc/html/rfc6241#section-8.1
+        sub_ele(hello, "session-id").text = "0"
+        xml = to_xml(hello).encode() + MSG_DELIM
+        head, tail = xml.rsplit(b">0<", 1)
+        self.head = head + b">"
+        self.tail = b"<" + tail
+
+    def to_bytes(self, session_id):
+        return b"%s%i%s" % (self.head, session_id, self.tail)
+
+
+def get_hello_cache(server):
+    config = getattr(server, "config", {})
+    with hello_cache_lock:
+        if not hasattr(server, "hello_cache"):
+            server.hello_cache = TimedCache(config.get("hello_cache_ttl", 5))
+            # emptied when a proxy response adds a stub
+            server.stub_caches.append(server.hello_cache)
+        return server.hello_cache
+
+
+class LocalStubs:
+    """Index of recorded replies to read RPCs, by fingerprint"""
+
+    def __init__(self, ttl):
+        self.cache = TimedCache(ttl)
+        self.reporter = ThreadPoolExecutor(1)
+
+    def match(self, request, load_stubs):
+        index = self.cache.get(lambda: index_stubs(load_stubs()))
+        return index.get(request["fingerprint"])
+
+    def report(self, post_request, request):
+        # mb still records the request, its response is not needed
+        self.reporter.submit(post_request, request)
+
+
+def get_local_stubs(server):
+    config = getattr(server, "config", {})
+    if not config.get("local_stubs"):
+        return None
+    with local_stubs_lock:
+        if not hasattr(server, "local_stubs"):
+            server.local_stubs = LocalStubs(config.get("local_stubs_ttl", 5))
+            server.stub_caches.append(server.local_stubs.cache)
+        return server.local_stubs
+
+
+def index_stubs(stubs):
+    index = dict()
+    for stub in stubs:
+        if matches_hello_only(stub):
+            # the recorded hello cannot shadow RPCs
+            continue
+        key = get_static_fingerprint(stub)
+        if key is None:
+            # mb uses the first matching stub, so stubs after one that
+            # cannot be indexed might be shadowed by it
+            break
+        if key.split(":")[0] in READ_OPERATIONS:
+            index.setdefault(key, stub["responses"][0]["is"])
+    return index
+
+
+def matches_hello_only(stub):
+    predicates = stub.get("predicates", [])
+    if len(predicates) != 1 or list(predicates[0]) not in [["equals"], ["deepEquals"]]:
+        return False
+    return next(iter(predicates[0].values())) == {"rpc": ""}
+
+
+def get_static_fingerprint(stub):
+    responses = stub.get("responses", [])
+    predicates = stub.get("predicates", [])
+    if len(responses) != 1 or set(responses[0]) != {"is"}:
+        return None
+    if "rpc-reply" not in responses[0]["is"]:
+        return None
+    if len(predicates) != 1 or list(predicates[0]) not in [["equals"], ["deepEquals"]]:
+        return None
+    fields = next(iter(predicates[0].values()))
+    if list(fields) == ["fingerprint"]:
+        return fields["fingerprint"]
+    if list(fields) != ["rpc"]:
+        return None
+    try:
+        return fingerprint(etree.fromstring(fields["rpc"]))
+    except (etree.XMLSyntaxError, ValueError):
+        return None
+
+
+def canonicalize(ele):
+    """C14N 2.0 of an element, without surrounding whitespace in text and
+    with generated namespace prefixes"""
+    return etree.canonicalize(ele, strip_text=True, rewrite_prefixes=True)
+
+
+def fingerprint(ele):
+    """Identifies an RPC by operation, datastore and a hash of its canonical form
+
+    For example get-config:running:1a2b3c4d5e6f7a8b"""
+    datastore = ""
+    for child in ele:
+        if etree.QName(child).localname in ["source", "target"] and len(child):
+            datastore = etree.QName(child[0]).localname
+            break
+    digest = hashlib.sha256(canonicalize(ele).encode()).hexdigest()[:16]
+    return f"{etree.QName(ele).localname}:{datastore}:{digest}"
+
+
+class Decoder:
+    """Incremental decoder of the messages of a session
+
+    Replaces ncclient's parser, which copies its whole buffer for each chunk
+    of base:1.1 framing. Received data is kept in a bytearray, which is
+    consumed from the front as messages are completed, and the data of
+    chunks is copied once into the message."""
+
+    def __init__(self, session):
+        self.session = session
+        self.buffer = bytearray()
+        self.message = bytearray()
+        # bytes of the current chunk that have not been received yet
+        self.remaining = 0
+        # where to continue searching for the end-of-message marker
+        self.searched = 0
+
+    def parse(self, data):
+        self.buffer += data
+        while True:
+            # the framing can change after each message, namely the hello
+            if self.session._base == NetconfBase.BASE_11:
+                message = self.decode_chunks()
+            else:
+                message = self.decode_message()
+            if message is None:
+                return
+            self.session._dispatch_message(message.decode())
+
+    def decode_message(self):
+        end = self.buffer.find(MSG_DELIM, self.searched)
+        if end == -1:
+            self.searched = max(len(self.buffer) - len(MSG_DELIM) + 1, 0)
+            return None
+        with memoryview(self.buffer) as view:
+            message = bytes(view[:end]).strip()
+        del self.buffer[: end + len(MSG_DELIM)]
+        self.searched = 0
+        return message
+
+    def decode_chunks(self):
+        """Returns the next complete message or None, keeping partial chunks"""
+        pos = 0
+        try:
+            while True:
+                if self.remaining:
+                    end = min(len(self.buffer), pos + self.remaining)
+                    with memoryview(self.buffer) as view:
+                        self.message += view[pos:end]
+                    self.remaining -= end - pos
+                    pos = end
+                    if self.remaining:
+                        return None
+                header_end = self.buffer.find(b"\n", pos + 1)
+                if header_end == -1:
+                    if len(self.buffer) - pos > MAX_CHUNK_HEADER:
+                        raise NetconfFramingError("Invalid chunk header")
+                    return None
+                header = self.buffer[pos:header_end]
+                pos = header_end + 1
+                # some clients omit the line feed before the first chunk
+                if header.startswith(b"\n"):
+                    header = header[1:]
+                if header == b"##":
+                    message = self.message
+                    self.message = bytearray()
+                    return message
+                size = header[1:]
+                if not header.startswith(b"#") or not size.isdigit():
+                    raise NetconfFramingError(f"Invalid chunk header {header!r}")
+                self.remaining = int(size)
+                if not 0 < self.remaining <= 4294967295 or size.startswith(b"0"):
+                    raise NetconfFramingError(f"Invalid chunk size {size!r}")
+        finally:
+            del self.buffer[:pos]
+
+
+def is_alive(manager):
+    return manager.connected
+
+
+def close(manager):
+    try:
+        manager.close_session()
+    except Exception:
+        logging.debug("Failed to close upstream session", exc_info=True)
+
+
 def add_message_id(rpc_reply, message_id):
-    ele = etree.fromstring(rpc_reply)
-    ele.set("message-id", message_id)
-    return to_xml(ele)
+    """Returns the pieces of the reply, with the message-id of the root element set
+
+    Only the root start tag is rewritten, the rest of the reply is neither
+    parsed nor copied as a whole. A reply without a root element raises
+    here, not while the pieces are written."""
+    match = ROOT_TAG.search(rpc_reply)
+    if not match:
+        raise ValueError("No root element in rpc-reply")
+    tag = MESSAGE_ID.sub("", match.group())
+    name_end = re.match(r"<[^\s/>]*", tag).end()
+    message_id = quoteattr(str(message_id), {'"': "&quot;"})
+    start_tag = f"{tag[:name_end]} message-id={message_id}{tag[name_end:]}"
+    return iter_pieces(rpc_reply, match, start_tag)
+
+
+def iter_pieces(rpc_reply, match, start_tag):
+    yield rpc_reply[: match.start()]
+    yield start_tag
+    for start in range(match.end(), len(rpc_reply), CHUNK_SIZE):
+        yield rpc_reply[start : start + CHUNK_SIZE]
+
+
+def rpc_error(message):
+    return (
+        f'<rpc-reply xmlns="{BASE_NS_1_0}"><rpc-error>'
+        "<error-type>application</error-type>"
+        "<error-tag>operation-failed</error-tag>"
+        "<error-severity>error</error-severity>"
+        f"<error-message>{escape(message)}</error-message>"
+        "</rpc-error></rpc-reply>"
+    )
+
+
+def remove_message_id(rpc_reply):
+    match = ROOT_TAG.search(rpc_reply)
+    if not match:
+        return rpc_reply
+    tag = MESSAGE_ID.sub("", match.group())
+    return rpc_reply[: match.start()] + tag + rpc_reply[match.end() :]
 
 
-def remove_message_id(root):
-    del root.attrib["message-id"]
-    return to_xml(root)
+def frame(pieces, base):
+    """Encodes the pieces of a message with the framing of the session"""
+    for piece in pieces:
+        data = piece.encode()
+        if not data:
+            continue
+        if base == NetconfBase.BASE_11:
+            yield b"\n#%i\n" % len(data)
+        yield data
+    yield END_DELIM if base == NetconfBase.BASE_11 else MSG_DELIM
 
 
 def to_xml(ele):
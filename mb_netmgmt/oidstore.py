@@ -0,0 +1,242 @@
+# This file is part of the project mb-netmgmt
+#
+# (C) 2022 Deutsche Telekom AG
+#
+# Deutsche Telekom AG and all other contributors / copyright
+# owners license this file to you under the terms of the GPL-2.0:
+#
+# mb-netmgmt is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+#
+# mb-netmgmt is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mb-netmgmt. If not, see <https://www.gnu.org/licenses/
+
+"""Compact store of recorded SNMP values
+
+The OIDs are sorted and packed as 32 bit big-endian sub-identifiers, so that
+byte order is OID order. The values are kept BER encoded. Both live in flat
+buffers with offset arrays, which can be written to a file and mapped into
+memory by several processes."""
+
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+from mb_netmgmt import ber, read_imposters
+
+MAGIC = b"MBOIDS01"
+HEADER = struct.Struct("=8sQQQQ")
+MAX_ARC = 2**32 - 1
+
+
+class OidStore:
+    def __init__(self, oids, oid_offsets, values, value_offsets, fallback=None):
+        self.oids = oids
+        self.oid_offsets = oid_offsets
+        self.values = values
+        self.value_offsets = value_offsets
+        # values that cannot be BER encoded, by position
+        self.fallback = fallback or {}
+        self.keys = Keys(self)
+
+    @classmethod
+    def from_values(cls, values, layouts=None, table=None):
+        """Builds a store from a dict of OIDs and values
+
+        Stores built with the same layouts share the OID buffers of equal
+        OID sets, and stores built with the same table share the values."""
+        if layouts is None:
+            layouts = dict()
+        if table is None:
+            table = ValueTable()
+        items = sorted(
+            ((oid_bytes(oid), value) for oid, value in values.items()),
+            key=lambda item: item[0],
+        )
+        oid_offsets = array("I", [0])
+        for key, value in items:
+            oid_offsets.append(oid_offsets[-1] + len(key))
+        oids = b"".join(key for key, value in items)
+        oids, oid_offsets = layouts.setdefault(
+            (oids, oid_offsets.tobytes()), (oids, oid_offsets)
+        )
+        value_offsets = array("I")
+        fallback = dict()
+        for i, (key, value) in enumerate(items):
+            try:
+                value_offsets.append(table.add(ber.encode_value(value)))
+            except ber.UnsupportedError:
+                value_offsets.append(0)
+                fallback[i] = value
+        return cls(oids, oid_offsets, table.data, value_offsets, fallback)
+
+    @classmethod
+    def from_stubs(cls, stubs):
+        return cls.from_values(recorded_values(stubs))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, count, oids_size, values_size, fallback_size = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an OID store")
+        sections = []
+        pos = HEADER.size
+        for size in [
+            (count + 1) * 4,
+            count * 4,
+            oids_size,
+            values_size,
+            fallback_size,
+        ]:
+            sections.append(view[pos : pos + size])
+            pos += size
+        oid_offsets, value_offsets, oids, values, fallback = sections
+        fallback = json.loads(bytes(fallback) or "{}")
+        return cls(
+            oids,
+            oid_offsets.cast("I"),
+            values,
+            value_offsets.cast("I"),
+            {int(i): value for i, value in fallback.items()},
+        )
+
+    def save(self, path):
+        fallback = json.dumps(self.fallback).encode() if self.fallback else b""
+        with open(path, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC, len(self), len(self.oids), len(self.values), len(fallback)
+                )
+            )
+            for section in [
+                self.oid_offsets,
+                self.value_offsets,
+                self.oids,
+                self.values,
+                fallback,
+            ]:
+                f.write(section)
+
+    def __len__(self):
+        return len(self.oid_offsets) - 1
+
+    def key(self, i):
+        return bytes(self.oids[self.oid_offsets[i] : self.oid_offsets[i + 1]])
+
+    def oid(self, i):
+        key = self.key(i)
+        return ".".join(map(str, struct.unpack(f">{len(key) // 4}I", key)))
+
+    def value(self, i):
+        if i in self.fallback:
+            return self.fallback[i]
+        tag, start, end = ber.read_header(self.values, self.value_offsets[i])
+        return ber.decode_value(tag, self.values[start:end])
+
+    def get(self, oid):
+        key = oid_bytes(oid)
+        i = bisect_left(self.keys, key)
+        if i < len(self) and self.key(i) == key:
+            return self.value(i)
+        parent = key[:-4]
+        i = bisect_left(self.keys, parent)
+        if i < len(self) and self.key(i).startswith(parent):
+            return exception_value("noSuchInstance")
+        return exception_value("noSuchObject")
+
+    def next(self, oid):
+        i = bisect_right(self.keys, oid_bytes(oid))
+        if i == len(self):
+            return oid, exception_value("endOfMibView")
+        return self.oid(i), self.value(i)
+
+    def bulk(self, oids, non_repeaters, max_repetitions):
+        non_repeaters = min(max(non_repeaters, 0), len(oids))
+        result = [self.next(oid) for oid in oids[:non_repeaters]]
+        repeaters = oids[non_repeaters:]
+        for _ in range(max(max_repetitions, 0)):
+            if not repeaters:
+                break
+            varbinds = [self.next(oid) for oid in repeaters]
+            result += varbinds
+            repeaters = [oid for oid, value in varbinds]
+            if all("endOfMibView" in value for oid, value in varbinds):
+                break
+        return result
+
+
+class Keys:
+    """Sequence of the packed OIDs of a store, for bisect"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        return self.store.key(i)
+
+
+class ValueTable:
+    """Buffer of encoded values that stores each distinct value once"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = dict()
+
+    def add(self, value):
+        offset = self.offsets.get(value)
+        if offset is None:
+            offset = self.offsets[value] = len(self.data)
+            self.data += value
+        return offset
+
+
+def read_stores(name):
+    """Builds a store per snmp imposter of a recording, by port"""
+    return {
+        imposter["port"]: OidStore.from_stubs(imposter.get("stubs", []))
+        for imposter in read_imposters(name)
+        if imposter["protocol"] == "snmp"
+    }
+
+
+def recorded_values(stubs):
+    values = dict()
+    for stub in stubs:
+        for response in stub.get("responses", []):
+            for oid, value in response.get("is", {}).items():
+                if oid.startswith("_") or is_exception(value):
+                    continue
+                values.setdefault(oid, value)
+    return values
+
+
+def oid_bytes(oid):
+    arcs = list(map(int, oid.strip(".").split(".")))
+    if max(arcs) > MAX_ARC:
+        # sub-identifiers are limited to 32 bits, larger ones sort last
+        arcs = [min(arc, MAX_ARC) for arc in arcs]
+    return struct.pack(f">{len(arcs)}I", *arcs)
+
+
+def is_exception(value):
+    return any(
+        exception in value
+        for exception in ["noSuchObject", "noSuchInstance", "endOfMibView"]
+    )
+
+
+def exception_value(exception):
+    return {"val": None, "tag": None, exception: 0}
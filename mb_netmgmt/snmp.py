@@ -17,97 +17,668 @@
 # You should have received a copy of the GNU General Public License
 # along with mb-netmgmt. If not, see <https://www.gnu.org/licenses/
 
-import binascii
+import asyncio
 import logging
+import struct
 from base64 import b64decode, b64encode
-from socket import SOCK_DGRAM, socket
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from itertools import count
+from socket import (
+    CMSG_SPACE,
+    IPPROTO_IP,
+    SO_REUSEADDR,
+    SOCK_DGRAM,
+    SOL_SOCKET,
+    gethostbyname,
+    inet_aton,
+    inet_ntoa,
+    socket,
+)
 from socketserver import DatagramRequestHandler, ThreadingUDPServer, UDPServer
+from threading import Lock, Thread
 
-from scapy.asn1.asn1 import ASN1_Class_UNIVERSAL
-from scapy.asn1.ber import BER_Decoding_Error
-from scapy.layers.snmp import SNMP, SNMPbulk, SNMPresponse, SNMPvarbind
+from mb_netmgmt import ber
+from mb_netmgmt.__main__ import Protocol, TimedCache, parse_to
+from mb_netmgmt.oidstore import OidStore, ValueTable, recorded_values
 
-from mb_netmgmt.__main__ import Protocol
+try:
+    from socket import IP_PKTINFO
+except ImportError:
+    # not exported by older Python versions, value of Linux
+    IP_PKTINFO = 8
 
-Server = ThreadingUDPServer
+UPSTREAM_TIMEOUT = 5
+UPSTREAM_RETRIES = 1
+GEN_ERR = 5
+upstream_lock = Lock()
+local_stubs_lock = Lock()
+simulator_lock = Lock()
+fleet_lock = Lock()
+response_cache_lock = Lock()
+# scapy layers for the PDU types, scapy is only imported when the BER codec
+# does not support a message, as it takes long to import
+PDU_LAYERS = {
+    ber.GET: "SNMPget",
+    ber.GETNEXT: "SNMPnext",
+    ber.RESPONSE: "SNMPresponse",
+    ber.SET: "SNMPset",
+    ber.GETBULK: "SNMPbulk",
+}
+PDU_TYPES = {name: pdu_type for pdu_type, name in PDU_LAYERS.items()}
 
 
 class Handler(DatagramRequestHandler, Protocol):
+    def setup(self):
+        self.local_address = None
+        if len(self.request) == 3:
+            *self.request, self.local_address = self.request
+        super().setup()
+
     def handle(self):
         self.callback_url = self.server.callback_url
         request, request_id = self.read_request()
         self.handle_request(request, request_id)
 
+    def finish(self):
+        if not self.local_address:
+            return super().finish()
+        # answer from the address the request was sent to
+        pktinfo = struct.pack("=i4s4s", 0, inet_aton(self.local_address), bytes(4))
+        self.socket.sendmsg(
+            [self.wfile.getvalue()],
+            [(IPPROTO_IP, IP_PKTINFO, pktinfo)],
+            0,
+            self.client_address,
+        )
+
     def handle_request(self, request, request_id):
+        fleet = get_fleet(self.server)
+        if fleet:
+            varbinds = fleet.answer(self.snmp_request, self.device, self.load_stubs)
+            if varbinds is not None:
+                return self.send_response(varbinds, request_id)
+        simulator = get_simulator(self.server)
+        if simulator:
+            varbinds = simulator.answer(self.snmp_request, self.load_stubs)
+            if varbinds is not None:
+                return self.send_response(varbinds, request_id)
+        local_stubs = get_local_stubs(self.server)
+        if local_stubs:
+            response = local_stubs.match(request, self.load_stubs)
+            if response is not None:
+                local_stubs.report(self.post_request, request)
+                return self.respond(response, request_id)
         mb_response = self.post_request(request)
         if "response" not in mb_response:
             self.open_upstream(mb_response["proxy"]["to"])
             self.send_upstream(request, request_id)
-        response = self.get_response(mb_response)
+        try:
+            response = self.get_response(mb_response)
+        except UpstreamError as e:
+            logging.warning(e)
+            return self.send_error(GEN_ERR, request_id)
         self.respond(response, request_id)
 
     def respond(self, response, request_id):
-        response_varbindlist = self.translate_json_to_network_response(response)
-        snmp_response = SNMP(
-            PDU=SNMPresponse(
-                id=request_id,
-                varbindlist=response_varbindlist,
-            )
+        varbinds = [
+            (oid, value) for oid, value in response.items() if not oid.startswith("_")
+        ]
+        error_status = response.get("_error_status", 0)
+        error_index = response.get("_error_index", 0)
+        self.send_response(varbinds, request_id, error_status, error_index)
+
+    def send_error(self, error_status, request_id):
+        varbinds = [(oid, value) for oid, value in self.snmp_request.varbinds]
+        self.send_response(varbinds, request_id, error_status)
+
+    def send_response(self, varbinds, request_id, error_status=0, error_index=0):
+        message = ber.Message(
+            self.snmp_request.version,
+            self.snmp_request.community,
+            ber.RESPONSE,
+            request_id,
+            error_status,
+            error_index,
+            varbinds,
         )
-        self.wfile.write(bytes(snmp_response))
+        response_cache = get_response_cache(self.server)
+        if response_cache:
+            self.wfile.write(response_cache.encode(message))
+        else:
+            self.wfile.write(to_bytes(message))
 
     def open_upstream(self, to):
-        self.upstream_socket = socket(type=SOCK_DGRAM)
-        self.upstream_socket.connect((to, 161))
+        self.upstream = get_upstream(self.server)
+        self.upstream_address = parse_upstream_address(to)
 
     def read_proxy_response(self):
-        bytes_response = self.upstream_socket.recv(UDPServer.max_packet_size)
+        config = getattr(self.server, "config", {})
+        bytes_response = self.upstream.request(
+            self.upstream_pdu_id,
+            self.upstream_request,
+            self.upstream_address,
+            config.get("upstream_timeout", UPSTREAM_TIMEOUT),
+            config.get("upstream_retries", UPSTREAM_RETRIES),
+        )
         try:
-            snmp_response = SNMP(bytes_response)
-        except BER_Decoding_Error:
+            snmp_response = from_bytes(bytes_response)
+        except DecodingError:
             logging.error(bytes_response)
             raise
-        result = dict()
-        for varbind in snmp_response.PDU.varbindlist:
-            result[varbind.oid.val] = to_dict(varbind)
-
-        return result
+        proxy_response = dict(snmp_response.varbinds)
+        if snmp_response.error_status:
+            proxy_response["_error_status"] = snmp_response.error_status
+            proxy_response["_error_index"] = snmp_response.error_index
+        return proxy_response
 
     def send_upstream(self, request, request_id):
-        oids = request["oids"]
-        pdu_type = type(self.snmp_request.PDU)
-        kwargs = dict()
-        if pdu_type == SNMPbulk:
-            kwargs["max_repetitions"] = 10
-        request = SNMP(
-            version="v2c",
-            community=self.snmp_request.community,
-            PDU=pdu_type(
-                id=self.snmp_request.PDU.id,
-                varbindlist=[SNMPvarbind(oid=oid) for oid in oids],
-                **kwargs,
-            ),
+        snmp_request = self.snmp_request
+        self.upstream_pdu_id = self.upstream.register()
+        error_status, error_index = 0, 0
+        if snmp_request.pdu_type == ber.GETBULK:
+            error_status = snmp_request.error_status
+            error_index = snmp_request.error_index
+        request = ber.Message(
+            1,
+            snmp_request.community,
+            snmp_request.pdu_type,
+            self.upstream_pdu_id,
+            error_status,
+            error_index,
+            [(oid, {"val": 0, "tag": "NULL"}) for oid in request["oids"]],
         )
-        self.upstream_socket.send(bytes(request))
+        self.upstream_request = to_bytes(request)
 
     def read_request(self):
-        self.snmp_request = SNMP(self.rfile.read())
-        pdu_id = self.snmp_request.PDU.id.val
-        json_request = {
-            "oids": [varbind.oid.val for varbind in self.snmp_request.PDU.varbindlist]
-        }
-        return json_request, pdu_id
+        self.snmp_request = from_bytes(self.rfile.read())
+        json_request = {"oids": [oid for oid, value in self.snmp_request.varbinds]}
+        fleet = get_fleet(self.server)
+        if fleet:
+            self.device = json_request["device"] = fleet.device(self)
+        return json_request, self.snmp_request.request_id
 
     def translate_request_to_json(self, varbind):
         return {"oid": varbind.oid.val}
 
-    def translate_json_to_network_response(self, json):
-        result = list()
-        for oid, response in json.items():
-            if oid.startswith("_"):
+
+class Server(ThreadingUDPServer):
+    def server_bind(self):
+        if getattr(self, "config", {}).get("fleet") == "address":
+            self.socket.setsockopt(IPPROTO_IP, IP_PKTINFO, 1)
+        super().server_bind()
+
+    def get_request(self):
+        if getattr(self, "config", {}).get("fleet") != "address":
+            return super().get_request()
+        data, ancdata, _, client_address = self.socket.recvmsg(
+            self.max_packet_size, CMSG_SPACE(12)
+        )
+        local_address = None
+        for level, type, cdata in ancdata:
+            if level == IPPROTO_IP and type == IP_PKTINFO:
+                # struct in_pktinfo: ifindex, local address, destination address
+                local_address = inet_ntoa(cdata[8:12])
+        return (data, self.socket, local_address), client_address
+
+    def server_close(self):
+        super().server_close()
+        close_upstream(self)
+        report_fleet(self)
+
+
+class AsyncioServer:
+    """UDP server that receives datagrams on an asyncio event loop
+
+    Requests are handled by a bounded pool of worker threads, so that the
+    callbacks to mb do not block the event loop. Datagrams arriving while
+    max_pending requests are in progress are dropped."""
+
+    allow_reuse_address = False
+    max_packet_size = UDPServer.max_packet_size
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.socket = socket(type=SOCK_DGRAM)
+        self.config = {}
+        self.pending = 0
+        if bind_and_activate:
+            self.server_bind()
+            self.server_activate()
+
+    def server_bind(self):
+        if self.allow_reuse_address:
+            self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        pass
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.max_pending = self.config.get("max_pending", 1000)
+        self.executor = ThreadPoolExecutor(self.config.get("callback_workers", 32))
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(self), sock=self.socket
+        )
+        try:
+            await self.stopped.wait()
+        finally:
+            self.transport.close()
+            self.executor.shutdown()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def server_close(self):
+        self.socket.close()
+        close_upstream(self)
+        report_fleet(self)
+
+    def datagram_received(self, data, client_address):
+        if self.pending >= self.max_pending:
+            logging.warning("Dropping request from %s", client_address)
+            return
+        self.pending += 1
+        future = self.loop.run_in_executor(
+            self.executor, self.process_request, data, client_address
+        )
+        future.add_done_callback(self.request_done)
+
+    def request_done(self, future):
+        self.pending -= 1
+
+    def process_request(self, data, client_address):
+        request = (data, self)
+        try:
+            self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+
+    def sendto(self, data, client_address):
+        self.loop.call_soon_threadsafe(self.transport.sendto, data, client_address)
+
+    def handle_error(self, request, client_address):
+        logging.exception("Error processing request from %s", client_address)
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.datagram_received(data, addr)
+
+
+class DecodingError(ValueError):
+    pass
+
+
+class UpstreamError(Exception):
+    """Raised if a device cannot be reached or does not respond"""
+
+
+class Upstream:
+    """UDP socket shared by all proxied requests
+
+    Each request gets its own PDU id, which is used to pass the response to
+    the waiting handler. Unanswered requests are sent again up to retries
+    times before UpstreamError is raised."""
+
+    def __init__(self):
+        self.socket = socket(type=SOCK_DGRAM)
+        self.socket.bind(("0.0.0.0", 0))
+        self.socket.settimeout(1)
+        self.lock = Lock()
+        self.pending = {}
+        self.pdu_ids = count(1)
+        self.closed = False
+        Thread(target=self.receive, daemon=True).start()
+
+    def register(self):
+        with self.lock:
+            pdu_id = next(self.pdu_ids) % 2**31
+            self.pending[pdu_id] = (Future(), None)
+        return pdu_id
+
+    def request(self, pdu_id, data, address, timeout, retries):
+        host, port = address
+        try:
+            address = (gethostbyname(host), port)
+            with self.lock:
+                future, _ = self.pending[pdu_id]
+                self.pending[pdu_id] = (future, address[0])
+            for _ in range(retries + 1):
+                self.socket.sendto(data, address)
+                try:
+                    return future.result(timeout)
+                except FutureTimeoutError:
+                    continue
+        except OSError as e:
+            raise UpstreamError(f"{host}:{port} is unreachable: {e}") from e
+        finally:
+            with self.lock:
+                self.pending.pop(pdu_id, None)
+        raise UpstreamError(f"No response from {host}:{port}")
+
+    def receive(self):
+        while not self.closed:
+            try:
+                data, (host, _) = self.socket.recvfrom(UDPServer.max_packet_size)
+            except TimeoutError:
                 continue
-            result += to_varbind(oid, response)
-        return result
+            except OSError:
+                if self.closed:
+                    return
+                continue
+            try:
+                pdu_id = from_bytes(data).request_id
+            except DecodingError:
+                logging.error(data)
+                continue
+            with self.lock:
+                future, expected_host = self.pending.get(pdu_id, (None, None))
+            if future and host == expected_host and not future.done():
+                future.set_result(data)
+
+    def close(self):
+        self.closed = True
+        self.socket.close()
+
+
+def get_upstream(server):
+    with upstream_lock:
+        if not hasattr(server, "upstream"):
+            server.upstream = Upstream()
+        return server.upstream
+
+
+def close_upstream(server):
+    with upstream_lock:
+        upstream = getattr(server, "upstream", None)
+    if upstream:
+        upstream.close()
+
+
+def parse_upstream_address(to):
+    if "://" not in to:
+        return to, 161
+    to = parse_to(to)
+    return to.hostname, to.port or 161
+
+
+class LocalStubs:
+    """Index of static stubs that can be answered without asking mb"""
+
+    def __init__(self, ttl):
+        self.cache = TimedCache(ttl)
+        self.reporter = ThreadPoolExecutor(1)
+
+    def match(self, request, load_stubs):
+        index = self.cache.get(lambda: index_stubs(load_stubs()))
+        return index.get(tuple(request["oids"]))
+
+    def report(self, post_request, request):
+        # mb still records the request, its response is not needed
+        self.reporter.submit(post_request, request)
+
+
+def get_local_stubs(server):
+    config = getattr(server, "config", {})
+    if not config.get("local_stubs"):
+        return None
+    with local_stubs_lock:
+        if not hasattr(server, "local_stubs"):
+            server.local_stubs = LocalStubs(config.get("local_stubs_ttl", 5))
+        return server.local_stubs
+
+
+def index_stubs(stubs):
+    index = dict()
+    for stub in stubs:
+        oids = get_static_oids(stub)
+        if oids is None:
+            # mb uses the first matching stub, so stubs after one that
+            # cannot be indexed might be shadowed by it
+            break
+        index.setdefault(oids, stub["responses"][0]["is"])
+    return index
+
+
+def get_static_oids(stub):
+    responses = stub.get("responses", [])
+    predicates = stub.get("predicates", [])
+    if len(responses) != 1 or set(responses[0]) != {"is"}:
+        return None
+    if len(predicates) != 1 or list(predicates[0]) != ["deepEquals"]:
+        return None
+    fields = predicates[0]["deepEquals"]
+    if list(fields) != ["oids"]:
+        return None
+    return tuple(fields["oids"])
+
+
+class Simulator:
+    """Answers GET, GETNEXT and GETBULK requests from the recorded values"""
+
+    def __init__(self, ttl, path=None):
+        self.cache = TimedCache(ttl)
+        self.store = OidStore.load(path) if path else None
+
+    def answer(self, request, load_stubs):
+        store = self.store or self.cache.get(lambda: OidStore.from_stubs(load_stubs()))
+        return simulate(store, request)
+
+
+class Fleet:
+    """Simulates a device per community string or per destination address
+
+    The values of a device are recorded in stubs with an equals or
+    deepEquals predicate on the device field of the request. Devices without
+    such stubs are answered from the stubs without one."""
+
+    def __init__(self, key, ttl):
+        self.key = key
+        self.cache = TimedCache(ttl)
+        self.lock = Lock()
+        self.counts = Counter()
+
+    def device(self, handler):
+        if self.key == "address":
+            return handler.local_address
+        return decode(handler.snmp_request.community)
+
+    def answer(self, request, device, load_stubs):
+        with self.lock:
+            self.counts[device] += 1
+        indexes = self.cache.get(lambda: index_devices(load_stubs()))
+        index = indexes.get(device, indexes.get(None))
+        if index is not None:
+            return simulate(index, request)
+
+    def report(self):
+        with self.lock:
+            counts = self.counts.most_common()
+        for device, count in counts:
+            logging.info("%s: %d requests", device, count)
+
+
+def simulate(index, request):
+    oids = [oid for oid, value in request.varbinds]
+    if request.pdu_type == ber.GET:
+        return [(oid, index.get(oid)) for oid in oids]
+    if request.pdu_type == ber.GETNEXT:
+        return [index.next(oid) for oid in oids]
+    if request.pdu_type == ber.GETBULK:
+        return index.bulk(oids, request.error_status, request.error_index)
+
+
+class ResponseCache:
+    """LRU cache of encoded responses, keyed by OIDs, community and version
+
+    A cached response is only used if its values are equal to the new
+    response, so changed stubs are picked up without explicit invalidation.
+    Only the request id is encoded per response."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.responses = OrderedDict()
+
+    def encode(self, message):
+        key = (
+            tuple(oid for oid, value in message.varbinds),
+            message.community,
+            message.version,
+        )
+        content = (message.error_status, message.error_index, message.varbinds)
+        with self.lock:
+            cached_content, body = self.responses.get(key, (None, None))
+            if cached_content == content:
+                self.responses.move_to_end(key)
+                return ber.encode_envelope(message, body)
+        try:
+            body = ber.encode_body(message)
+        except ber.UnsupportedError:
+            return bytes(to_scapy(message))
+        with self.lock:
+            self.responses[key] = (content, body)
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.max_size:
+                self.responses.popitem(last=False)
+        return ber.encode_envelope(message, body)
+
+    def clear(self):
+        with self.lock:
+            self.responses.clear()
+
+
+def get_response_cache(server):
+    config = getattr(server, "config", {})
+    max_size = config.get("response_cache_size", 1000)
+    if not max_size:
+        return None
+    with response_cache_lock:
+        if not hasattr(server, "response_cache"):
+            server.response_cache = ResponseCache(max_size)
+        return server.response_cache
+
+
+def get_fleet(server):
+    config = getattr(server, "config", {})
+    if not config.get("fleet"):
+        return None
+    with fleet_lock:
+        if not hasattr(server, "fleet"):
+            server.fleet = Fleet(config["fleet"], config.get("simulator_ttl", 5))
+        return server.fleet
+
+
+def report_fleet(server):
+    fleet = getattr(server, "fleet", None)
+    if fleet:
+        fleet.report()
+
+
+def index_devices(stubs):
+    """Builds an OidStore per device, sharing the buffers between devices"""
+    stubs_by_device = dict()
+    for stub in stubs:
+        stubs_by_device.setdefault(get_device(stub), []).append(stub)
+    layouts = dict()
+    table = ValueTable()
+    return {
+        device: OidStore.from_values(recorded_values(device_stubs), layouts, table)
+        for device, device_stubs in stubs_by_device.items()
+    }
+
+
+def get_device(stub):
+    for predicate in stub.get("predicates", []):
+        for operator in ["equals", "deepEquals"]:
+            fields = predicate.get(operator)
+            if isinstance(fields, dict) and "device" in fields:
+                return fields["device"]
+    return None
+
+
+def get_simulator(server):
+    config = getattr(server, "config", {})
+    if not config.get("simulator"):
+        return None
+    with simulator_lock:
+        if not hasattr(server, "simulator"):
+            server.simulator = Simulator(
+                config.get("simulator_ttl", 5), config.get("simulator_file")
+            )
+        return server.simulator
+
+
+def from_bytes(data):
+    try:
+        return ber.decode_message(data)
+    except ber.UnsupportedError:
+        pass
+    from scapy.asn1.ber import BER_Decoding_Error
+    from scapy.layers.snmp import SNMP
+
+    try:
+        return from_scapy(SNMP(data))
+    except (BER_Decoding_Error, KeyError) as e:
+        raise DecodingError(f"Invalid SNMP message: {e!r}") from e
+
+
+def to_bytes(message):
+    try:
+        return ber.encode_message(message)
+    except ber.UnsupportedError:
+        return bytes(to_scapy(message))
+
+
+def from_scapy(snmp):
+    pdu = snmp.PDU
+    pdu_type = PDU_TYPES[type(pdu).__name__]
+    if pdu_type == ber.GETBULK:
+        error_status, error_index = pdu.non_repeaters, pdu.max_repetitions
+    else:
+        error_status, error_index = pdu.error, pdu.error_index
+    return ber.Message(
+        snmp.version.val,
+        snmp.community.val,
+        pdu_type,
+        pdu.id.val,
+        error_status.val,
+        error_index.val,
+        [(varbind.oid.val, to_dict(varbind)) for varbind in pdu.varbindlist],
+    )
+
+
+def to_scapy(message):
+    from scapy.layers import snmp
+
+    kwargs = dict()
+    if message.pdu_type == ber.GETBULK:
+        kwargs["non_repeaters"] = message.error_status
+        kwargs["max_repetitions"] = message.error_index
+    else:
+        kwargs["error"] = message.error_status
+        kwargs["error_index"] = message.error_index
+    return snmp.SNMP(
+        version=message.version,
+        community=message.community,
+        PDU=getattr(snmp, PDU_LAYERS[message.pdu_type])(
+            id=message.request_id,
+            varbindlist=[to_varbind(oid, value) for oid, value in message.varbinds],
+            **kwargs,
+        ),
+    )
 
 
 def decode(value):
@@ -136,16 +707,19 @@ def to_dict(varbind):
 
 
 def to_varbind(oid, response):
+    from scapy.asn1.asn1 import ASN1_Class_UNIVERSAL
+    from scapy.layers.snmp import SNMPvarbind
+
     value = response["val"]
     try:
         value = b64decode(value, validate=True)
-    except (binascii.Error, TypeError):
+    # binascii.Error and non-ASCII strings both raise a ValueError
+    except (ValueError, TypeError):
         pass
     try:
         asn1_class = ASN1_Class_UNIVERSAL.__dict__[response["tag"]]
         value = asn1_class.asn1_object(value)
     except KeyError:
         pass
-    del response["val"]
-    del response["tag"]
-    return SNMPvarbind(oid=oid, value=value, **response)
+    kwargs = {k: v for k, v in response.items() if k not in ["val", "tag"]}
+    return SNMPvarbind(oid=oid, value=value, **kwargs)
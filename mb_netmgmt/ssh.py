@@ -17,15 +17,25 @@
 # You should have received a copy of the GNU General Public License
 # along with mb-netmgmt. If not, see <https://www.gnu.org/licenses/
 
-import re
+import io
+import logging
+import os
 from socketserver import BaseRequestHandler
 from socketserver import ThreadingTCPServer as Server
+from threading import Lock
 
 import paramiko
 
-from mb_netmgmt.__main__ import Protocol, get_cli_patterns
+from mb_netmgmt.__main__ import (
+    CLI_PROMPT,
+    PromptMatcher,
+    Protocol,
+    get_upstream_pool,
+    upstream_key,
+)
 
 stopped = False
+host_keys_lock = Lock()
 
 
 class ParamikoServer(paramiko.ServerInterface):
@@ -53,6 +63,7 @@ class ParamikoServer(paramiko.ServerInterface):
             height,
             pixelwidth,
             pixelheight,
+            transport.upstream_pool,
         )
         channel.command_prompt = b"#"
         channel.command_prompt = handle_prompt(self.handle_request)
@@ -69,13 +80,25 @@ class Handler(BaseRequestHandler, Protocol):
     def handle(self):
         self.callback_url = self.server.callback_url
         transport = start_server(
-            self.request, self.get_to(), self.key_filename, self.handle_request
+            self.request,
+            self.get_to(),
+            self.key_filename,
+            self.handle_request,
+            get_host_keys(self.server),
+            get_upstream_pool(self.server, is_alive, paramiko.SSHClient.close),
         )
         self.channel = transport.accept()
         while not stopped:
             request, request_id = self.read_request()
+            if self.channel.closed:
+                break
             self.handle_request(request, request_id)
 
+    def finish(self):
+        upstream = getattr(getattr(self, "channel", None), "upstream", None)
+        if upstream:
+            close_upstream(upstream)
+
     def send_upstream(self, request, request_id):
         self.channel.upstream.sendall(request["command"])
 
@@ -89,26 +112,49 @@ class Handler(BaseRequestHandler, Protocol):
         return response
 
     def read_proxy_response(self):
-        prompt_patterns = [self.channel.command_prompt]
-        prompt_patterns += get_cli_patterns()
+        prompt_patterns = [self.channel.command_prompt, CLI_PROMPT]
         message = self.read_message(self.channel.upstream, prompt_patterns)
         return {"response": message.decode()}
 
     def read_message(self, channel, patterns):
-        message = b""
-        end_of_message = False
-        while not end_of_message and not stopped:
-            message += channel.recv(1024)
-            for pattern in patterns:
-                if re.findall(pattern, message):
-                    end_of_message = True
-                    break
-        return message
-
-
-def open_upstream(to, key_filename, term, width, height, pixelwidth, pixelheight):
+        matcher = PromptMatcher(patterns)
+        while not stopped:
+            chunk = channel.recv(1024)
+            if not chunk:
+                break
+            if matcher.feed(chunk):
+                logging.debug("prompt: %s", matcher.match.lastgroup)
+                break
+        return matcher.message()
+
+
+def open_upstream(
+    to, key_filename, term, width, height, pixelwidth, pixelheight, upstream_pool=None
+):
     if not to:
         return
+    shell = (term, width, height, pixelwidth, pixelheight)
+    if upstream_pool:
+        client = upstream_pool.acquire(
+            upstream_key(to, key_filename), lambda: connect(to, key_filename)
+        )
+        try:
+            channel = client.invoke_shell(*shell)
+        except (paramiko.SSHException, EOFError):
+            # the pooled session was closed by the device in the meantime
+            client.close()
+            client = connect(to, key_filename)
+            channel = client.invoke_shell(*shell)
+    else:
+        client = connect(to, key_filename)
+        channel = client.invoke_shell(*shell)
+    channel.client = client
+    channel.upstream_pool = upstream_pool
+    channel.upstream_key = upstream_key(to, key_filename)
+    return channel
+
+
+def connect(to, key_filename):
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
     client.connect(
@@ -120,7 +166,20 @@ def open_upstream(to, key_filename, term, width, height, pixelwidth, pixelheight
         transport_factory=paramiko.Transport,
         look_for_keys=False,
     )
-    return client.invoke_shell(term, width, height, pixelwidth, pixelheight)
+    return client
+
+
+def close_upstream(channel):
+    channel.close()
+    if channel.upstream_pool:
+        channel.upstream_pool.release(channel.upstream_key, channel.client)
+    else:
+        channel.client.close()
+
+
+def is_alive(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
 
 
 def handle_prompt(handle_request):
@@ -129,14 +188,71 @@ def handle_prompt(handle_request):
     return command_prompt
 
 
-def start_server(request, to, key_filename, handle_request):
+def start_server(
+    request, to, key_filename, handle_request, host_keys=None, upstream_pool=None
+):
     t = paramiko.Transport(request)
-    t.add_server_key(paramiko.DSSKey.generate())
-    t.add_server_key(paramiko.ECDSAKey.generate())
-    t.add_server_key(paramiko.RSAKey.generate(4096))
+    for host_key in host_keys or generate_host_keys():
+        t.add_server_key(host_key)
     t.to = to
     t.key_filename = key_filename
+    t.upstream_pool = upstream_pool
     paramiko_server = ParamikoServer()
     paramiko_server.handle_request = handle_request
     t.start_server(server=paramiko_server)
     return t
+
+
+def get_host_keys(server):
+    with host_keys_lock:
+        if not hasattr(server, "host_keys"):
+            server.host_keys = load_host_keys(getattr(server, "config", {}))
+        return server.host_keys
+
+
+def load_host_keys(config):
+    if config.get("host_keys"):
+        return [read_host_key(key) for key in config["host_keys"]]
+    host_key_dir = config.get("host_key_dir")
+    if not host_key_dir:
+        return generate_host_keys()
+    os.makedirs(host_key_dir, exist_ok=True)
+    filenames = sorted(
+        os.path.join(host_key_dir, filename)
+        for filename in os.listdir(host_key_dir)
+        if filename.endswith("_key")
+    )
+    if filenames:
+        return [read_host_key_file(filename) for filename in filenames]
+    host_keys = generate_host_keys()
+    for host_key in host_keys:
+        filename = f"ssh_host_{host_key.get_name()}_key"
+        host_key.write_private_key_file(os.path.join(host_key_dir, filename))
+    return host_keys
+
+
+def read_host_key(key):
+    for key_class in [
+        paramiko.RSAKey,
+        paramiko.ECDSAKey,
+        paramiko.Ed25519Key,
+        paramiko.DSSKey,
+    ]:
+        try:
+            return key_class.from_private_key(io.StringIO(key))
+        except paramiko.SSHException:
+            pass
+    raise ValueError("Unsupported host key")
+
+
+def read_host_key_file(filename):
+    with open(filename) as f:
+        return read_host_key(f.read())
+
+
+def generate_host_keys():
+    return [
+        paramiko.DSSKey.generate(),
+        paramiko.ECDSAKey.generate(),
+        paramiko.RSAKey.generate(4096),
+    ]
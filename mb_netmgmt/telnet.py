@@ -22,8 +22,6 @@ import time
 from socketserver import StreamRequestHandler
 from socketserver import ThreadingTCPServer as Server
 
-from Exscript.protocols import Telnet
-
 from mb_netmgmt.__main__ import Protocol
 
 
@@ -72,6 +70,9 @@ class Handler(StreamRequestHandler, Protocol):
         username_prompt = b"Username: "
         to = self.get_to()
         if to:
+            # imported here, as Exscript takes long to import
+            from Exscript.protocols import Telnet
+
             t = Telnet(debug=4)
             t.connect(to.hostname)
             result = t.expect(t.get_username_prompt())
@@ -1,20 +1,55 @@
+import copy
 import io
 import os
 import re
+import socket
+import subprocess
+import sys
+import time
 from base64 import b64encode
 from threading import Thread
+from types import SimpleNamespace
+from unittest.mock import Mock
 from urllib.parse import urlparse
 
 import ncclient.manager
 import paramiko
 import pytest
+from lxml import etree
 from ncclient.devices.default import DefaultDeviceHandler
-from ncclient.transport.session import BASE_NS_1_0, MSG_DELIM, to_ele
+from ncclient.transport.errors import NetconfFramingError
+from ncclient.transport.session import (
+    BASE_NS_1_0,
+    END_DELIM,
+    MSG_DELIM,
+    NetconfBase,
+)
 from scapy.asn1.asn1 import ASN1_OID
-from scapy.layers.snmp import ASN1_NULL, SNMPvarbind
+from scapy.layers.snmp import (
+    ASN1_NULL,
+    SNMP,
+    SNMPbulk,
+    SNMPget,
+    SNMPnext,
+    SNMPvarbind,
+)
 
-from mb_netmgmt import mb, netconf, snmp, ssh, use_scalar_strings, yaml
-from mb_netmgmt.__main__ import create_server, get_cli_patterns, parse_to
+import mb_netmgmt
+from mb_netmgmt import ber, mb, netconf, snmp, ssh, use_scalar_strings, yaml
+from mb_netmgmt.__main__ import (
+    ConnectionPool,
+    PromptMatcher,
+    Protocol,
+    TimedCache,
+    create_server,
+    create_session,
+    get_cli_patterns,
+    match_cli_prompt,
+    parse_to,
+    start_workers,
+    stop_workers,
+)
+from mb_netmgmt.oidstore import OidStore
 
 port = 8081
 prompt = b"prompt#"
@@ -58,6 +93,17 @@ cli_responses = [
 ]
 
 
+@pytest.mark.parametrize("protocol", ["snmp", "telnet"])
+def test_lazy_imports(protocol):
+    code = (
+        f"import sys, mb_netmgmt.__main__, mb_netmgmt.{protocol}; print(*sys.modules)"
+    )
+    modules = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    ).stdout.split()
+    assert not {"scapy", "paramiko", "Exscript", "ruamel.yaml"} & set(modules)
+
+
 @pytest.mark.parametrize("protocol", ["http", "snmp", "telnet", "netconf"])
 def test_create_imposter(protocol):
     with mb(imposter(protocol, None)):
@@ -110,6 +156,24 @@ def test_create_ssh_server():
     server.shutdown()
 
 
+def test_host_keys_from_directory(tmp_path):
+    # created if it does not exist yet
+    server = SimpleNamespace(config={"host_key_dir": str(tmp_path / "keys")})
+    host_keys = ssh.get_host_keys(server)
+    assert ssh.get_host_keys(server) is host_keys
+    reloaded = ssh.load_host_keys(server.config)
+    assert {k.get_fingerprint() for k in reloaded} == {
+        k.get_fingerprint() for k in host_keys
+    }
+
+
+def test_host_keys_from_imposter():
+    key = io.StringIO()
+    paramiko.ECDSAKey.generate().write_private_key(key)
+    host_keys = ssh.load_host_keys({"host_keys": [key.getvalue()]})
+    assert [k.get_name() for k in host_keys] == ["ecdsa-sha2-nistp256"]
+
+
 def connect_ssh():
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
@@ -122,15 +186,22 @@ def test_create_netconf_server():
     original_open_upstream = netconf.Handler.open_upstream
     original_post_request = netconf.Handler.post_request
     netconf.Handler.open_upstream = lambda handler: None
-    netconf.Handler.post_request = mock_post_request
+    requests = []
+    netconf.Handler.post_request = lambda handler, request: (
+        requests.append(request) or mock_post_request(handler, request)
+    )
     server = create_server(netconf, port, None)
     Thread(target=server.serve_forever).start()
-    with ncclient.manager.connect(
-        host="localhost", port=port, password="", hostkey_verify=False
-    ) as m:
-        assert m.session_id == "1"
-        assert "urn:ietf:params:netconf:base:1.0" in m.server_capabilities
-        m.get_config("running")
+    session_ids = []
+    for _ in range(2):
+        with ncclient.manager.connect(
+            host="localhost", port=port, password="", hostkey_verify=False
+        ) as m:
+            session_ids.append(m.session_id)
+            assert "urn:ietf:params:netconf:base:1.0" in m.server_capabilities
+            m.get_config("running")
+    assert session_ids == ["1", "2"]
+    assert requests.count({"rpc": ""}) == 1
     netconf.stopped = True
     server.shutdown()
     netconf.stopped = False
@@ -167,6 +238,7 @@ def test_netconf_upstream():
         ),
         "debug",
     ):
+        handler.to = handler.get_to()
         handler.open_upstream()
         handler.send_upstream(
             {"rpc": "<get-config>running</get-config>"},
@@ -189,11 +261,204 @@ def create_proxy_response(message_id):
 
 def test_remove_message_id():
     result = netconf.remove_message_id(
-        to_ele(f'<rpc-reply xmlns="{BASE_NS_1_0}" message-id="42"><blubb/></rpc-reply>')
+        f"""<rpc-reply message-id="42" xmlns="{BASE_NS_1_0}">
+  <blubb/>
+</rpc-reply>"""
     )
     assert result == mock_response
 
 
+@pytest.mark.parametrize(
+    "rpc_reply,expected",
+    [
+        ("<rpc-reply/>", '<rpc-reply message-id="a&amp;&quot;b"/>'),
+        (
+            "<?xml version='1.0'?>\n<rpc-reply message-id='1' a='>'><ok/></rpc-reply>",
+            "<?xml version='1.0'?>\n<rpc-reply message-id=\"a&amp;&quot;b\" a='>'><ok/></rpc-reply>",
+        ),
+    ],
+)
+def test_add_message_id(rpc_reply, expected):
+    assert "".join(netconf.add_message_id(rpc_reply, 'a&"b')) == expected
+
+
+@pytest.mark.parametrize(
+    "base,expected",
+    [
+        (NetconfBase.BASE_10, b"<a>\xc3\xa4</a>" + MSG_DELIM),
+        (NetconfBase.BASE_11, b"\n#3\n<a>\n#2\n\xc3\xa4\n#4\n</a>" + END_DELIM),
+    ],
+)
+def test_frame(base, expected):
+    assert b"".join(netconf.frame(["<a>", "", "ä", "</a>"], base)) == expected
+
+
+def test_netconf_session_ids_of_workers():
+    session_ids = []
+    for worker in range(3):
+        server = netconf.Server(
+            ("localhost", 0), netconf.Handler, bind_and_activate=False
+        )
+        server.config = {"workers": 3}
+        server.worker = worker
+        session_ids += [server.next_session_id() for _ in range(2)]
+        server.server_close()
+    assert session_ids == [1, 4, 2, 5, 3, 6]
+
+
+def test_netconf_pipelining():
+    handler = netconf.Handler.__new__(netconf.Handler)
+    handler.server = SimpleNamespace(config={"rpc_workers": 4})
+    handler.setup()
+    written = []
+    handler.write = lambda pieces: written.append("".join(pieces))
+    delays = {"1": 0.3, "2": 0.1, "3": 0.2, "4": 0}
+
+    def handle_request(request, message_id):
+        time.sleep(delays[message_id])
+        return handler.respond({}, message_id)
+
+    handler.handle_request = handle_request
+    start = time.perf_counter()
+    for message_id in delays:
+        handler.dispatch({"rpc": "<get/>"}, message_id)
+    handler.executor.shutdown()
+    assert time.perf_counter() - start < sum(delays.values())
+    assert [re.search('message-id="(.)"', reply)[1] for reply in written] == list(
+        delays
+    )
+
+
+@pytest.mark.parametrize("rpc_workers", [1, 4])
+def test_netconf_rpc_error(rpc_workers):
+    handler = netconf.Handler.__new__(netconf.Handler)
+    handler.server = SimpleNamespace(config={"rpc_workers": rpc_workers})
+    handler.setup()
+    written = []
+    handler.write = lambda pieces: written.append("".join(pieces))
+
+    def handle_request(request, message_id):
+        if message_id == "1":
+            raise ValueError("<mb> is not running")
+        return handler.respond({}, message_id)
+
+    handler.handle_request = handle_request
+    for message_id in ["1", "2"]:
+        handler.dispatch({"rpc": "<get/>"}, message_id)
+    if handler.executor:
+        handler.executor.shutdown()
+    error = etree.fromstring(written[0])
+    assert error.get("message-id") == "1"
+    assert (
+        error.findtext(f"{{{BASE_NS_1_0}}}rpc-error/{{{BASE_NS_1_0}}}error-message")
+        == "<mb> is not running"
+    )
+    assert 'message-id="2"' in written[1]
+
+
+def test_netconf_malformed_rpc_reply():
+    handler = netconf.Handler.__new__(netconf.Handler)
+    handler.server = SimpleNamespace(config={})
+    handler.setup()
+    handler.handle_request = lambda request, message_id: handler.respond(
+        {"rpc-reply": "no reply"}, message_id
+    )
+    reply = etree.fromstring("".join(handler.handle_rpc({"rpc": "<get/>"}, "1")))
+    assert reply.get("message-id") == "1"
+    assert (
+        reply.findtext(f"{{{BASE_NS_1_0}}}rpc-error/{{{BASE_NS_1_0}}}error-message")
+        == "No root element in rpc-reply"
+    )
+
+
+def test_netconf_fingerprint():
+    requests = [
+        f"""<get-config xmlns="{BASE_NS_1_0}">
+  <source><running/></source>
+  <filter type="subtree" xmlns:x="urn:x"><x:a b="1" c="2"/></filter>
+</get-config>""",
+        f'<nc:get-config xmlns:nc="{BASE_NS_1_0}"><nc:source><nc:running/>'
+        '</nc:source><nc:filter type="subtree"><y:a xmlns:y="urn:x" c="2" b="1"/>'
+        "</nc:filter></nc:get-config>",
+    ]
+    fingerprints = {netconf.fingerprint(etree.fromstring(r)) for r in requests}
+    assert len(fingerprints) == 1
+    assert fingerprints.pop().startswith("get-config:running:")
+    candidate = requests[1].replace("running", "candidate")
+    assert netconf.fingerprint(etree.fromstring(candidate)).startswith(
+        "get-config:candidate:"
+    )
+
+
+def test_netconf_index_stubs():
+    rpc = f'<get xmlns="{BASE_NS_1_0}"><filter><a/></filter></get>'
+    key = netconf.fingerprint(etree.fromstring(rpc))
+    reply = {"rpc-reply": mock_response}
+    stubs = [
+        # a proxied recording starts with the hello of the device
+        {
+            "predicates": [{"deepEquals": {"rpc": ""}}],
+            "responses": [{"is": {"response": [BASE_NS_1_0]}}],
+        },
+        {
+            "predicates": [{"deepEquals": {"rpc": rpc.replace("<a/>", " <a/> ")}}],
+            "responses": [{"is": reply}],
+        },
+        {
+            "predicates": [{"equals": {"fingerprint": "get::other"}}],
+            "responses": [{"is": {"rpc-reply": "<rpc-reply/>"}}],
+        },
+        {
+            "predicates": [{"equals": {"rpc": f'<commit xmlns="{BASE_NS_1_0}"/>'}}],
+            "responses": [{"is": {"rpc-reply": "<rpc-reply/>"}}],
+        },
+        {"responses": [{"proxy": {"to": "netconf://example.org"}}]},
+        {
+            "predicates": [{"equals": {"fingerprint": "get::shadowed"}}],
+            "responses": [{"is": reply}],
+        },
+    ]
+    assert netconf.index_stubs(stubs) == {
+        key: reply,
+        "get::other": {"rpc-reply": "<rpc-reply/>"},
+    }
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 4096])
+def test_netconf_decoder(read_size):
+    messages = []
+
+    def dispatch_message(message):
+        messages.append(message)
+        # the hello switches to base:1.1 framing
+        session._base = NetconfBase.BASE_11
+
+    session = SimpleNamespace(_base=NetconfBase.BASE_10)
+    session._dispatch_message = dispatch_message
+    decoder = netconf.Decoder(session)
+    data = (
+        b"<hello/>\n"
+        + MSG_DELIM
+        # without the line feed before the first chunk
+        + b"#3\n<a>\n#6\n\xc3\xa4</a>"
+        + END_DELIM
+        + b"".join(netconf.frame(["<b>", "x" * 20000, "</b>"], NetconfBase.BASE_11))
+    )
+    for start in range(0, len(data), read_size):
+        decoder.parse(data[start : start + read_size])
+    assert messages == ["<hello/>", "<a>ä</a>", "<b>" + "x" * 20000 + "</b>"]
+    assert not decoder.buffer
+
+
+@pytest.mark.parametrize(
+    "data", [b"\n#0\n", b"\n#01\n0", b"\n#x\n", b"\n#123456789012345"]
+)
+def test_netconf_decoder_error(data):
+    decoder = netconf.Decoder(SimpleNamespace(_base=NetconfBase.BASE_11))
+    with pytest.raises(NetconfFramingError):
+        decoder.parse(data)
+
+
 def test_netconf_default_response():
     with mb(imposter("netconf")):
         with ncclient.manager.connect(
@@ -245,6 +510,160 @@ def test_use_scalar_strings(base, result):
     assert s.read() == result
 
 
+recording = [
+    {"imposter": {"port": 8023, "protocol": "telnet"}},
+    {"stub": {"responses": [{"is": {"response": "line 1\r\nline 2"}}]}},
+    {"stub": {"responses": [{"is": {"response": "prompt#"}}]}},
+    {"imposter": {"port": 8161, "protocol": "snmp"}},
+]
+
+
+@pytest.mark.parametrize(
+    "name", ["imposters.yaml", "imposters.ndjson", "imposters.yaml.gz"]
+)
+def test_records(tmp_path, name):
+    mb_netmgmt.write_records(tmp_path / name, iter(recording))
+    assert list(mb_netmgmt.read_records(tmp_path / name)) == recording
+
+
+@pytest.mark.parametrize(
+    "serializer", [mb_netmgmt.LibYaml, mb_netmgmt.RoundTripYaml, mb_netmgmt.Json]
+)
+def test_serializers(serializer):
+    s = io.StringIO()
+    serializer().dump({"imposters": recording}, s)
+    s.seek(0)
+    assert serializer().load(s) == {"imposters": recording}
+
+
+def test_libyaml_scalar_strings():
+    s = io.StringIO()
+    mb_netmgmt.LibYaml().dump({"a": "line 1\nline 2", "b": "line 1\r\n"}, s)
+    assert s.getvalue() == 'a: |-\n  line 1\n  line 2\nb: "line 1\\r\\n"\n'
+
+
+def test_libyaml_loads_ruamel_recordings(tmp_path):
+    # ruamel writes YAML 1.2, where these scalars are plain strings or octal
+    recorded = {"strings": ["on", "yes", "12:30", "="], "numbers": [0o17, 12, 0.5]}
+    with open(tmp_path / "imposters.yaml", "w") as f:
+        mb_netmgmt.RoundTripYaml().dump(recorded, f)
+    with open(tmp_path / "imposters.yaml") as f:
+        assert mb_netmgmt.LibYaml().load(f) == recorded
+
+
+def test_recording_path():
+    assert mb_netmgmt.recording_path("imposters") == "imposters.yaml"
+    assert mb_netmgmt.recording_path("imposters.json.gz") == "imposters.json.gz"
+
+
+def test_deduplicate_records(tmp_path):
+    output = "interface Loopback0\r\n" * 10
+    records = [
+        {"stub": {"responses": [{"is": {"response": output}}]}} for _ in range(3)
+    ]
+    mb_netmgmt.write_records(
+        tmp_path / "imposters.ndjson",
+        mb_netmgmt.deduplicate_records(iter(copy.deepcopy(records))),
+    )
+    assert (tmp_path / "imposters.ndjson").read_text().count("Loopback0") == 10
+    read = mb_netmgmt.resolve_records(
+        mb_netmgmt.read_records(tmp_path / "imposters.ndjson")
+    )
+    assert list(read) == records
+
+
+def test_read_deduplicated_imposters(tmp_path):
+    imposter = {
+        "port": 8023,
+        "stubs": [{"responses": [{"is": {"response": "x" * 100}}]}],
+    }
+    imposters = {"imposters": [copy.deepcopy(imposter)]}
+    imposters["blobs"] = mb_netmgmt.deduplicate_stub(
+        imposters["imposters"][0]["stubs"][0], set()
+    )
+    mb_netmgmt.dump(imposters, tmp_path / "imposters.json")
+    assert mb_netmgmt.read_imposters(tmp_path / "imposters.json") == [imposter]
+
+
+def test_put_imposters_backoff(monkeypatch):
+    delays = []
+    attempts = iter([mb_netmgmt.requests.ConnectionError()] * 8 + [Mock()])
+
+    def put(url, json):
+        result = next(attempts)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(mb_netmgmt.requests, "put", put)
+    monkeypatch.setattr(mb_netmgmt.time, "sleep", delays.append)
+    mb_netmgmt.put_imposters("localhost", [])
+    assert delays == [0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.5, 0.5]
+
+
+def test_put_imposters_timeout(monkeypatch):
+    monkeypatch.setattr(
+        mb_netmgmt.requests,
+        "put",
+        Mock(side_effect=mb_netmgmt.requests.ConnectionError),
+    )
+    with pytest.raises(TimeoutError):
+        mb_netmgmt.put_imposters("localhost", [], timeout=0.05)
+
+
+def test_mb_reuse_deletes_own_imposters(monkeypatch):
+    deleted = []
+    monkeypatch.setattr(mb_netmgmt, "start_shared_mb", Mock())
+    monkeypatch.setattr(
+        mb_netmgmt,
+        "post_imposter",
+        lambda host, imposter, timeout: {"port": imposter.get("port", 8100)},
+    )
+    monkeypatch.setattr(mb_netmgmt.requests, "delete", deleted.append)
+    with mb_netmgmt.mb([{"port": 8023}, {"protocol": "snmp"}], reuse=True):
+        assert deleted == []
+    assert deleted == [
+        "http://localhost:2525/imposters/8023",
+        "http://localhost:2525/imposters/8100",
+    ]
+
+
+def test_is_running_timeout(monkeypatch):
+    monkeypatch.setattr(
+        mb_netmgmt.requests, "get", Mock(side_effect=mb_netmgmt.requests.ReadTimeout)
+    )
+    assert not mb_netmgmt.is_running("localhost")
+
+
+def test_stub_batches():
+    batches = list(mb_netmgmt.stub_batches(recording, 1))
+    assert [(imposter["port"], len(stubs)) for imposter, stubs in batches] == [
+        (8023, 1),
+        (8023, 1),
+        (8023, 0),
+        (8161, 0),
+    ]
+
+
+def test_import_imposters(tmp_path, monkeypatch):
+    requests = []
+    session = Mock()
+    session.__enter__ = Mock(return_value=session)
+    session.__exit__ = Mock(return_value=False)
+    session.delete.side_effect = lambda url: requests.append(("DELETE", url))
+    session.post.side_effect = lambda url, json: requests.append(("POST", url))
+    monkeypatch.setattr(mb_netmgmt.requests, "Session", lambda: session)
+    monkeypatch.setattr(mb_netmgmt, "check_response", lambda response: None)
+    mb_netmgmt.write_records(tmp_path / "imposters.ndjson", iter(recording))
+    mb_netmgmt.import_imposters(tmp_path / "imposters.ndjson", batch_size=1)
+    assert requests == [
+        ("DELETE", "http://localhost:2525/imposters"),
+        ("POST", "http://localhost:2525/imposters"),
+        ("POST", "http://localhost:2525/imposters/8023/stubs"),
+        ("POST", "http://localhost:2525/imposters"),
+    ]
+
+
 @pytest.mark.parametrize("cli_response,result", cli_responses)
 def test_cli_patterns(cli_response, result):
     matched = False
@@ -255,6 +674,433 @@ def test_cli_patterns(cli_response, result):
     assert matched == result
 
 
+@pytest.mark.parametrize("cli_response,result", cli_responses)
+def test_match_cli_prompt(cli_response, result):
+    assert bool(match_cli_prompt(cli_response)) == result
+
+
+@pytest.mark.parametrize(
+    "cli_response,prompt_class",
+    [
+        (b"\rIOS-1(config)#", "ios"),
+        (b"\rRP/0/8/CPU0:IOSXR-2#", "ios_xr"),
+        (b"\rProtocol [ipv4]: ", "interactive"),
+        (b"\r --More-- ", "more"),
+        (b"\r[node0_RP0_CPU0:~]$", "xr_shell"),
+    ],
+)
+def test_match_cli_prompt_class(cli_response, prompt_class):
+    assert match_cli_prompt(cli_response) == prompt_class
+
+
+def test_prompt_matcher():
+    matcher = PromptMatcher(get_cli_patterns())
+    assert not matcher.feed(b"interface Loopback0\r\n" * 1000)
+    assert not matcher.feed(b"end\r\n\rIOS")
+    assert matcher.feed(b"-1#")
+    assert matcher.message().endswith(b"end\r\n\rIOS-1#")
+
+
+def snmp_get(
+    port, *oids, pdu_id=42, pdu_type=SNMPget, community="public", host="localhost"
+):
+    request = SNMP(
+        community=community,
+        PDU=pdu_type(id=pdu_id, varbindlist=[SNMPvarbind(oid=oid) for oid in oids]),
+    )
+    with socket.socket(type=socket.SOCK_DGRAM) as s:
+        s.settimeout(5)
+        s.sendto(bytes(request), (host, port))
+        data, (response_host, _) = s.recvfrom(65535)
+        assert response_host == socket.gethostbyname(host)
+        return SNMP(data)
+
+
+def mock_snmp_post_request(handler, request):
+    return {
+        "response": {oid: {"val": "mocked", "tag": "STRING"} for oid in request["oids"]}
+    }
+
+
+def test_snmp_asyncio_server(monkeypatch):
+    monkeypatch.setattr(snmp.Handler, "post_request", mock_snmp_post_request)
+    server = create_server(snmp, 8161, None, {"asyncio": True})
+    Thread(target=server.serve_forever).start()
+    try:
+        response = snmp_get(8161, "1.3.6.1.2.1.1.5.0")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert response.PDU.id.val == 42
+    assert response.PDU.varbindlist[0].value.val == b"mocked"
+
+
+class ProxyHandler(snmp.Handler):
+    def post_request(self, request):
+        return {"proxy": {"to": "snmp://localhost:8166"}, "callbackURL": None}
+
+    def post_proxy_response(self, mb_response, proxy_response):
+        return proxy_response
+
+
+@pytest.mark.parametrize("asyncio", [False, True])
+def test_snmp_proxy(monkeypatch, asyncio):
+    monkeypatch.setattr(snmp.Handler, "post_request", mock_snmp_post_request)
+    device = create_server(snmp, 8166, None)
+    proxy = create_server(
+        SimpleNamespace(
+            Server=snmp.Server, AsyncioServer=snmp.AsyncioServer, Handler=ProxyHandler
+        ),
+        8165,
+        None,
+        {"asyncio": asyncio},
+    )
+    Thread(target=device.serve_forever).start()
+    Thread(target=proxy.serve_forever).start()
+    try:
+        responses = [snmp_get(8165, "1.3.6.1.2.1.1.5.0", pdu_id=i) for i in range(3)]
+    finally:
+        for server in [device, proxy]:
+            server.shutdown()
+            server.server_close()
+    assert [response.PDU.id.val for response in responses] == [0, 1, 2]
+    assert responses[0].PDU.varbindlist[0].value.val == b"mocked"
+
+
+def test_snmp_proxy_timeout():
+    with socket.socket(type=socket.SOCK_DGRAM) as device:
+        device.settimeout(5)
+        device.bind(("localhost", 8166))
+        proxy = create_server(
+            SimpleNamespace(Server=snmp.Server, Handler=ProxyHandler),
+            8165,
+            None,
+            {"upstream_timeout": 0.1, "upstream_retries": 1},
+        )
+        Thread(target=proxy.serve_forever).start()
+        try:
+            response = snmp_get(8165, "1.3.6.1.2.1.1.5.0")
+            requests = [device.recv(65535) for _ in range(2)]
+        finally:
+            proxy.shutdown()
+            proxy.server_close()
+    assert response.PDU.error.val == snmp.GEN_ERR
+    assert response.PDU.varbindlist[0].oid.val == "1.3.6.1.2.1.1.5.0"
+    assert requests[0] == requests[1]
+
+
+def test_snmp_workers(monkeypatch):
+    monkeypatch.setattr(
+        snmp.Handler,
+        "post_request",
+        lambda handler, request: {
+            "response": {
+                oid: {"val": str(os.getpid()), "tag": "STRING"}
+                for oid in request["oids"]
+            }
+        },
+    )
+    server = create_server(snmp, 8167, None, {"workers": 2})
+    workers = start_workers(server, snmp, 8167, None, {"workers": 2})
+    Thread(target=server.serve_forever).start()
+    try:
+        responses = [snmp_get(8167, "1.3.6.1.2.1.1.5.0") for _ in range(20)]
+    finally:
+        stop_workers(workers)
+        server.shutdown()
+        server.server_close()
+    pids = {response.PDU.varbindlist[0].value.val for response in responses}
+    assert len(pids) == 2
+
+
+def test_workers_share_host_keys():
+    server = create_server(ssh, 8169, None, {"workers": 2})
+    workers = start_workers(server, ssh, 8169, None, {"workers": 2})
+    Thread(target=server.serve_forever).start()
+    fingerprints = set()
+    try:
+        for _ in range(10):
+            with socket.create_connection(("localhost", 8169)) as sock:
+                transport = paramiko.Transport(sock)
+                transport.start_client()
+                fingerprints.add(transport.get_remote_server_key().get_fingerprint())
+                transport.close()
+    finally:
+        stop_workers(workers)
+        server.shutdown()
+    assert len(fingerprints) == 1
+
+
+def test_parse_upstream_address():
+    assert snmp.parse_upstream_address("example.org") == ("example.org", 161)
+    assert snmp.parse_upstream_address("snmp://example.org:1161") == (
+        "example.org",
+        1161,
+    )
+
+
+def snmp_stub(oids, response, operator="deepEquals"):
+    return {
+        "predicates": [{operator: {"oids": oids}}],
+        "responses": [{"is": response}],
+    }
+
+
+def test_index_stubs():
+    sys_name = {"1.3.6.1.2.1.1.5.0": {"val": "router", "tag": "STRING"}}
+    stubs = [
+        snmp_stub(["1.3.6.1.2.1.1.5.0"], sys_name),
+        snmp_stub(["1.3.6.1.2.1.1.5.0"], {}),
+        snmp_stub(["1.3.6.1.2.1.1.3.0"], {}, "startsWith"),
+        snmp_stub(["1.3.6.1.2.1.1.1.0"], {}),
+    ]
+    assert snmp.index_stubs(stubs) == {("1.3.6.1.2.1.1.5.0",): sys_name}
+
+
+def test_snmp_local_stubs(monkeypatch):
+    reported = []
+    monkeypatch.setattr(
+        snmp.Handler, "post_request", lambda handler, request: reported.append(request)
+    )
+    monkeypatch.setattr(
+        snmp.Handler,
+        "load_stubs",
+        lambda handler: [
+            snmp_stub(
+                ["1.3.6.1.2.1.1.5.0"],
+                {"1.3.6.1.2.1.1.5.0": {"val": "router", "tag": "STRING"}},
+            )
+        ],
+    )
+    server = create_server(snmp, 8163, None, {"local_stubs": True})
+    Thread(target=server.serve_forever).start()
+    try:
+        response = snmp_get(8163, "1.3.6.1.2.1.1.5.0")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert response.PDU.varbindlist[0].value.val == b"router"
+    server.local_stubs.reporter.shutdown()
+    assert reported == [{"oids": ["1.3.6.1.2.1.1.5.0"]}]
+
+
+def oid_index():
+    return OidStore.from_values(
+        {
+            oid: {"val": oid, "tag": "STRING"}
+            for oid in [
+                "1.3.6.1.2.1.2.2.1.2.10",
+                "1.3.6.1.2.1.2.2.1.2.9",
+                "1.3.6.1.2.1.1.5.0",
+            ]
+        }
+    )
+
+
+def test_oid_index_get():
+    index = oid_index()
+    assert index.get("1.3.6.1.2.1.1.5.0")["val"] == "1.3.6.1.2.1.1.5.0"
+    assert "noSuchInstance" in index.get("1.3.6.1.2.1.1.5.1")
+    assert "noSuchObject" in index.get("1.3.6.1.2.1.1.6.0")
+
+
+def test_oid_index_next():
+    index = oid_index()
+    assert index.next("1.3.6.1.2.1.1")[0] == "1.3.6.1.2.1.1.5.0"
+    assert index.next("1.3.6.1.2.1.2.2.1.2.9")[0] == "1.3.6.1.2.1.2.2.1.2.10"
+    oid, value = index.next("1.3.6.1.2.1.2.2.1.2.10")
+    assert oid == "1.3.6.1.2.1.2.2.1.2.10"
+    assert "endOfMibView" in value
+
+
+def test_oid_index_bulk():
+    result = oid_index().bulk(["1.3.6.1.2.1.1", "1.3.6.1.2.1.2"], 1, 3)
+    assert [oid for oid, value in result] == [
+        "1.3.6.1.2.1.1.5.0",
+        "1.3.6.1.2.1.2.2.1.2.9",
+        "1.3.6.1.2.1.2.2.1.2.10",
+        "1.3.6.1.2.1.2.2.1.2.10",
+    ]
+    assert "endOfMibView" in result[-1][1]
+
+
+def test_oid_store_file(tmp_path):
+    store = OidStore.from_values(
+        {
+            "1.3.6.1.2.1.1.3.0": {"val": 123, "tag": "TIME_TICKS"},
+            "1.3.6.1.2.1.1.5.0": {"val": "router", "tag": "STRING"},
+            "1.3.6.1.2.1.1.6.0": {"val": "unsupported", "tag": "OPAQUE"},
+        }
+    )
+    store.save(tmp_path / "store")
+    loaded = OidStore.load(tmp_path / "store")
+    assert len(loaded) == 3
+    assert loaded.get("1.3.6.1.2.1.1.3.0") == {"val": 123, "tag": "TIME_TICKS"}
+    assert loaded.next("1.3.6.1.2.1.1.3.0") == (
+        "1.3.6.1.2.1.1.5.0",
+        {"val": "router", "tag": "STRING"},
+    )
+    assert loaded.get("1.3.6.1.2.1.1.6.0") == {"val": "unsupported", "tag": "OPAQUE"}
+
+
+def test_snmp_simulator(monkeypatch):
+    monkeypatch.setattr(
+        snmp.Handler,
+        "load_stubs",
+        lambda handler: [
+            snmp_stub(
+                ["1.3.6.1.2.1.1.5.0"],
+                {"1.3.6.1.2.1.1.5.0": {"val": "router", "tag": "STRING"}},
+            )
+        ],
+    )
+    server = create_server(snmp, 8164, None, {"simulator": True})
+    Thread(target=server.serve_forever).start()
+    try:
+        response = snmp_get(8164, "1.3.6.1.2.1.1", pdu_type=SNMPnext)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert response.PDU.varbindlist[0].oid.val == "1.3.6.1.2.1.1.5.0"
+    assert response.PDU.varbindlist[0].value.val == b"router"
+
+
+ber_values = [
+    {"val": 0, "tag": "INTEGER"},
+    {"val": 127, "tag": "INTEGER"},
+    {"val": 128, "tag": "INTEGER"},
+    {"val": -129, "tag": "INTEGER"},
+    {"val": 2**32 - 1, "tag": "COUNTER32"},
+    {"val": 2**64 - 1, "tag": "COUNTER64"},
+    {"val": 42, "tag": "GAUGE32"},
+    {"val": 123456, "tag": "TIME_TICKS"},
+    {"val": "router", "tag": "STRING"},
+    {"val": "é" * 100, "tag": "STRING"},
+    {"val": b64encode(b"\xff\x00").decode(), "tag": "STRING"},
+    {"val": "1.3.6.1.4.1.9.1.1709", "tag": "OID"},
+    {"val": b64encode(b"1.3.6.1.4.1.9.1.1709"), "tag": "OID"},
+    {"val": "192.0.2.1", "tag": "IPADDRESS"},
+    {"val": 0, "tag": "NULL"},
+    {"val": None, "tag": None, "noSuchObject": 0},
+    {"val": None, "tag": None, "noSuchInstance": 0},
+    {"val": None, "tag": None, "endOfMibView": 0},
+]
+
+
+@pytest.mark.parametrize("value", ber_values)
+def test_ber_encode_message(value):
+    message = ber.Message(
+        1, b"public", ber.RESPONSE, 4242, 0, 0, [("1.3.6.1.2.1.1.5.0", value)]
+    )
+    assert ber.encode_message(message) == bytes(snmp.to_scapy(message))
+
+
+@pytest.mark.parametrize("value", ber_values)
+def test_ber_decode_message(value):
+    message = ber.Message(
+        1, b"public", ber.RESPONSE, 4242, 0, 0, [("1.3.6.1.2.1.1.5.0", value)]
+    )
+    data = bytes(snmp.to_scapy(message))
+    assert ber.decode_message(data) == snmp.from_scapy(SNMP(data))
+
+
+def test_ber_decode_bulk_request():
+    data = bytes(
+        SNMP(
+            community="private",
+            PDU=SNMPbulk(
+                id=7,
+                non_repeaters=1,
+                max_repetitions=25,
+                varbindlist=[SNMPvarbind(oid="1.3.6.1.2.1.1"), SNMPvarbind(oid="1.3")],
+            ),
+        )
+    )
+    message = ber.decode_message(data)
+    assert message == snmp.from_scapy(SNMP(data))
+    assert (message.pdu_type, message.error_status, message.error_index) == (
+        ber.GETBULK,
+        1,
+        25,
+    )
+
+
+def test_ber_unsupported_value():
+    message = ber.Message(
+        1, b"public", ber.RESPONSE, 1, 0, 0, [("1.3", {"val": 1, "tag": "BOOLEAN"})]
+    )
+    with pytest.raises(ber.UnsupportedError):
+        ber.encode_message(message)
+    assert snmp.to_bytes(message) == bytes(snmp.to_scapy(message))
+
+
+fleet_sys_name = {"val": "mb-netmgmt", "tag": "STRING"}
+
+
+def fleet_stubs():
+    return [
+        {
+            "predicates": [
+                {"deepEquals": {"oids": ["1.3.6.1.2.1.1.5.0"], "device": device}}
+            ],
+            "responses": [
+                {"is": {"1.3.6.1.2.1.1.5.0": {"val": device, "tag": "STRING"}}}
+            ],
+        }
+        for device in ["router1", "127.0.0.2"]
+    ] + [snmp_stub(["1.3.6.1.2.1.1.5.0"], {"1.3.6.1.2.1.1.5.0": fleet_sys_name})]
+
+
+def test_index_devices():
+    indexes = snmp.index_devices(fleet_stubs())
+    assert set(indexes) == {"router1", "127.0.0.2", None}
+    assert indexes["router1"].oids is indexes[None].oids
+    assert indexes[None].get("1.3.6.1.2.1.1.5.0") == fleet_sys_name
+
+
+@pytest.mark.parametrize(
+    "fleet,kwargs,expected",
+    [
+        ("community", {"community": "router1"}, b"router1"),
+        ("community", {"community": "router2"}, b"mb-netmgmt"),
+        ("address", {"host": "127.0.0.2"}, b"127.0.0.2"),
+        ("address", {"host": "127.0.0.1"}, b"mb-netmgmt"),
+    ],
+)
+def test_snmp_fleet(monkeypatch, fleet, kwargs, expected):
+    reported = []
+    monkeypatch.setattr(
+        snmp.Handler, "post_request", lambda handler, request: reported.append(request)
+    )
+    monkeypatch.setattr(snmp.Handler, "load_stubs", lambda handler: fleet_stubs())
+    server = create_server(snmp, 8168, None, {"fleet": fleet})
+    Thread(target=server.serve_forever).start()
+    try:
+        response = snmp_get(8168, "1.3.6.1.2.1.1.5.0", **kwargs)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert response.PDU.varbindlist[0].value.val == expected
+    assert sum(server.fleet.counts.values()) == 1
+    assert not reported
+
+
+def test_response_cache():
+    cache = snmp.ResponseCache(1)
+    varbinds = [("1.3.6.1.2.1.1.5.0", {"val": "router", "tag": "STRING"})]
+    message = ber.Message(0, b"private", ber.RESPONSE, 1, 0, 0, varbinds)
+    assert cache.encode(message) == ber.encode_message(message)
+    message = message._replace(request_id=300)
+    assert cache.encode(message) == ber.encode_message(message)
+    message = message._replace(
+        varbinds=[("1.3.6.1.2.1.1.5.0", {"val": "switch", "tag": "STRING"})]
+    )
+    assert cache.encode(message) == ber.encode_message(message)
+    message = message._replace(community=b"public")
+    assert cache.encode(message) == ber.encode_message(message)
+    assert len(cache.responses) == 1
+
+
 def test_snmp_no_such_instance():
     pkt = b"0\x10\x06\x0c+\x06\x01\x02\x01/\x01\x01\x01\x01\n\x01\x81\x00"
     result = SNMPvarbind(pkt)
@@ -288,6 +1134,91 @@ def test_to_varbind_no_such_instance():
     )
 
 
+def test_create_session():
+    session = create_session({"callback_pool_size": 4})
+    assert session.get_adapter("http://localhost:2525")._pool_maxsize == 4
+
+
+def test_request_mb_uses_server_session():
+    handler = Protocol()
+    handler.server = SimpleNamespace(session=Mock(), callback_timeout=5)
+    handler.request_mb("GET", "http://localhost:2525/imposters/8081")
+    handler.server.session.request.assert_called_once_with(
+        "GET", "http://localhost:2525/imposters/8081", timeout=5
+    )
+
+
+def test_proxy_cache():
+    handler = Protocol()
+    handler.server = SimpleNamespace(
+        callback_url="http://localhost:2525/imposters/8081/_requests",
+        proxy_cache=TimedCache(60),
+    )
+    imposter_response = Mock()
+    proxy = {"to": "ssh://localhost:2222", "key": "key", "disabled_algorithms": {}}
+    imposter_response.json.return_value = {"stubs": [{"responses": [{"proxy": proxy}]}]}
+    handler.request_mb = Mock(return_value=imposter_response)
+    assert handler.get_to().port == 2222
+    key_filename = handler.key_filename
+    with open(key_filename) as f:
+        assert f.read() == "key"
+    assert handler.get_to().port == 2222
+    assert handler.request_mb.call_count == 1
+    assert handler.key_filename == key_filename
+    handler.server.proxy_cache.invalidate()
+    handler.get_to()
+    assert handler.request_mb.call_count == 2
+
+
+def test_disable_algorithms():
+    original_transport = paramiko.Transport
+    try:
+        mb_netmgmt.__main__.disable_algorithms({})
+        patched_transport = paramiko.Transport
+        for _ in range(2000):
+            mb_netmgmt.__main__.disable_algorithms({"ciphers": ["aes128-cbc"]})
+        assert paramiko.Transport is patched_transport
+        transport = paramiko.Transport(socket.socket())
+        assert transport.disabled_algorithms == {"ciphers": ["aes128-cbc"]}
+        transport.close()
+    finally:
+        paramiko.Transport = original_transport
+
+
+def test_stub_caches():
+    handler = Protocol()
+    cache = TimedCache(60)
+    handler.server = SimpleNamespace(stub_caches=[cache])
+    assert cache.get(lambda: "old") == "old"
+    handler.request_mb = Mock()
+    handler.request_mb.return_value.json.return_value = {"response": {}}
+    handler.post_proxy_response({"callbackURL": "http://localhost:2525/x"}, {})
+    assert cache.get(lambda: "new") == "new"
+
+
+def test_connection_pool():
+    closed = []
+    pool = ConnectionPool(1, 300, True, lambda c: c != "dead", closed.append)
+    assert pool.acquire("key", lambda: "first") == "first"
+    pool.release("key", "first")
+    pool.release("key", "second")
+    assert closed == ["second"]
+    assert pool.acquire("key", lambda: "third") == "first"
+    assert pool.acquire("other", lambda: "fourth") == "fourth"
+    assert pool.metrics() == {"hits": 1, "misses": 2}
+
+
+def test_connection_pool_drops_unusable_connections():
+    closed = []
+    pool = ConnectionPool(2, 300, True, lambda c: c != "dead", closed.append)
+    pool.release("key", "dead")
+    assert pool.acquire("key", lambda: "new") == "new"
+    pool.idle_timeout = -1
+    pool.release("key", "idle")
+    assert pool.acquire("key", lambda: "new") == "new"
+    assert closed == ["dead", "idle"]
+
+
 def test_parse_to():
     assert parse_to("telnet://localhost").hostname == "localhost"
     assert parse_to("telnet://localhost:23").port == 23